@@ -0,0 +1,213 @@
+# Answer analytics for the quiz and the orientation games.
+#
+# Every graded answer becomes an event. Requests only put events on a
+# bounded queue and bump the in-memory totals; a background thread drains
+# the queue into instance/analytics.sqlite3, a batch per transaction, so no
+# request waits on the disk. When the writer falls behind and the queue is
+# full, new events are dropped and counted rather than blocking the worker
+# that answered. Dropped events are left out of the totals, which only
+# count answers that were queued to be written, however the server runs.
+#
+# Totals per quiz question and per orientation-game section are kept in a
+# table of their own, updated in the same transaction as the events, and
+# loaded at startup: /analytics/stats never scans the raw events.
+#
+# In a forked worker (see serve.py) the writer is restarted, and totals
+# come from that table, read on one connection per worker, plus the
+# worker's own unwritten events, since every worker writes its own
+# answers.
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'analytics.sqlite3')
+
+# Events waiting for the writer before new ones are dropped
+QUEUE_SIZE = 10000
+
+# Most events written per transaction
+BATCH_SIZE = 500
+
+# Seconds the writer waits for a first event before checking again
+POLL_INTERVAL = 1.0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    choice TEXT,
+    correct INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS totals (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    answered INTEGER NOT NULL,
+    wrong INTEGER NOT NULL,
+    PRIMARY KEY (kind, key)
+);
+'''
+
+UPSERT_TOTAL = '''
+INSERT INTO totals (kind, key, answered, wrong) VALUES (?, ?, 1, ?)
+ON CONFLICT (kind, key) DO UPDATE SET answered = answered + 1, wrong = wrong + excluded.wrong
+'''
+
+
+class AnswerLog:
+    def __init__(self, path=DB_PATH, queue_size=QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        # {(kind, key): [answered, wrong]}, everything ever recorded, and
+        # what's still to be written
+        self._totals = {}
+        self._pending = {}
+        self._forked = False
+        # Forked workers' connection for reading the shared totals
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        # Writer stats
+        self.written = self.dropped = self.failed = self.batches = 0
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        db = self._connect()
+        try:
+            for kind, key, answered, wrong in db.execute('SELECT kind, key, answered, wrong FROM totals'):
+                self._totals[kind, key] = [answered, wrong]
+        finally:
+            db.close()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        db.executescript(SCHEMA)
+        return db
+
+    def _after_fork(self):
+        # The parent's writer didn't survive the fork, and its queue and
+        # lock may be in any state
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._forked = True
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='answer-log', daemon=True)
+                self._thread.start()
+
+    def record(self, kind, key, choice, correct):
+        # Log one answer ("quiz" per question id, "orientation" per section).
+        # Returns False if the queue was full and the event won't be written;
+        # it isn't counted in the totals then.
+        event = (time.time(), kind, key, choice, int(bool(correct)))
+        with self._lock:
+            # Queued under the lock, so the writer can't take the event off
+            # the pending counts before it's been added
+            try:
+                self._queue.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            for totals in (self._totals, self._pending):
+                total = totals.setdefault((kind, key), [0, 0])
+                total[0] += 1
+                total[1] += not correct
+        return True
+
+    def _run(self):
+        db = self._connect()
+        while True:
+            try:
+                batch = [self._queue.get(timeout=POLL_INTERVAL)]
+            except queue.Empty:
+                continue
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                with db:
+                    db.executemany('INSERT INTO events (at, kind, key, choice, correct) VALUES (?, ?, ?, ?, ?)',
+                                   batch)
+                    db.executemany(UPSERT_TOTAL, [(kind, key, 1 - correct)
+                                                  for _, kind, key, _, correct in batch])
+                with self._lock:
+                    self.written += len(batch)
+                    self.batches += 1
+            except sqlite3.Error:
+                log.exception("Couldn't write %d answer events", len(batch))
+                with self._lock:
+                    self.failed += len(batch)
+            with self._lock:
+                for _, kind, key, _, correct in batch:
+                    self._pending[kind, key][0] -= 1
+                    self._pending[kind, key][1] -= 1 - correct
+            for _ in batch:
+                self._queue.task_done()
+
+    def flush(self):
+        # Wait until every queued event has been written (or failed)
+        self._queue.join()
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def _shared_totals(self):
+        # Every worker's written answers, plus this one's unwritten ones
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = sqlite3.connect(self.path, check_same_thread=False)
+            totals = {(kind, key): [answered, wrong] for kind, key, answered, wrong
+                      in self._reader.execute('SELECT kind, key, answered, wrong FROM totals')}
+        with self._lock:
+            for key, (answered, wrong) in self._pending.items():
+                total = totals.setdefault(key, [0, 0])
+                total[0] += answered
+                total[1] += wrong
+        return totals
+
+    def stats(self):
+        totals = self._shared_totals() if self._forked else None
+        with self._lock:
+            if totals is None:
+                totals = self._totals
+            groups = {'quiz': {}, 'orientation': {}}
+            for (kind, key), (answered, wrong) in sorted(totals.items()):
+                if not answered:
+                    continue
+                groups.setdefault(kind, {})[key] = {
+                    'answered': answered,
+                    'wrong': wrong,
+                    'error_rate': wrong / answered,
+                }
+            return {
+                'questions': groups.pop('quiz'),
+                'sections': groups.pop('orientation'),
+                'queued': self.queued(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'batches': self.batches,
+            }
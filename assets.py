@@ -0,0 +1,490 @@
+# Optimized static assets: offline build steps and the runtime lookup.
+#
+# `python assets.py` writes everything the pages load to static/build under
+# content-hashed names, listed in static/build/manifest.json:
+#
+# - every image in static/images, resized and recompressed as WebP plus a
+#   JPEG (or, for images with transparency, PNG) fallback at a few widths;
+# - one CSS and one JS bundle shared by every page and one JS bundle per
+#   page, concatenated and minified from BUNDLES, each with a gzip (and, if
+#   the brotli package is installed, brotli) copy next to it.
+#
+# The libraries the layout used to take from CDNs live in static/vendor;
+# `python assets.py vendor` downloads them (and the fonts their CSS points
+# to) once, from VENDOR. Building the bundles without them is an error;
+# until they're vendored, unbuilt pages load them from the CDNs instead.
+# Building images needs Pillow; serving doesn't.
+#
+# At runtime Assets maps an image's original URL to its variants for
+# `srcset` and a bundle name to its URL, and serves static/build at
+# /assets/, picking the precompressed copy that matches Accept-Encoding.
+# A built file never changes under the same name, so it goes out with a
+# year-long immutable Cache-Control. Without a manifest (the build hasn't
+# been run) pages fall back to the original files under static/.
+
+import gzip
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+
+from flask import request, send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT, 'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_PATH = os.path.join(BUILD_DIR, 'manifest.json')
+
+# Widths generated for each image, never wider than the original
+IMAGE_WIDTHS = (480, 960, 1600)
+IMAGE_TYPES = ('.jpg', '.jpeg', '.png')
+JPEG_QUALITY = 82
+WEBP_QUALITY = 80
+
+# Seconds browsers may keep a built file
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+# Third-party files kept under static/, and where `vendor` fetches them
+VENDOR = {
+    'vendor/bootstrap/bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/css/bootstrap.min.css',
+    'vendor/bootstrap/bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.2.3/dist/js/bootstrap.bundle.min.js',
+    'vendor/fontawesome/css/all.min.css': 'https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.4.0/css/all.min.css',
+    'vendor/fonts/hanken-grotesk.css': 'https://fonts.googleapis.com/css2?family=Hanken+Grotesk:wght@400..800&display=swap',
+    'vendor/jquery/jquery.min.js': 'https://code.jquery.com/jquery-3.6.0.min.js',
+}
+
+# Bundles and their sources, paths under static/, in load order. "base"
+# goes on every page; the others on the page they're named after.
+BUNDLES = {
+    'base.css': ['vendor/fonts/hanken-grotesk.css', 'vendor/bootstrap/bootstrap.min.css',
+                 'vendor/fontawesome/css/all.min.css', 'css/style.css'],
+    'base.js': ['vendor/jquery/jquery.min.js', 'vendor/bootstrap/bootstrap.bundle.min.js', 'main.js'],
+    'learn.js': ['js/learn.js'],
+    'orientation_game.js': ['js/orientation_game.js'],
+    'quiz.js': ['js/quiz.js'],
+    'simulator.js': ['js/simulator.js'],
+}
+
+# Precompressed copies, best first, as (Accept-Encoding token, suffix)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Browsers only get WOFF2 fonts from Google Fonts if they look modern
+USER_AGENT = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+def _hashed_name(name, data, ext):
+    return f"{name}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _encode(image, fmt):
+    out = io.BytesIO()
+    if fmt == 'JPEG':
+        image.convert('RGB').save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    elif fmt == 'PNG':
+        image.save(out, 'PNG', optimize=True)
+    else:
+        image.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+    return out.getvalue()
+
+
+def build_images(source=os.path.join(STATIC_DIR, 'images'), build=BUILD_DIR):
+    # Write the image variants; returns the manifest's "images" section,
+    # keyed by path under static/
+    from PIL import Image, ImageOps
+
+    images = {}
+    os.makedirs(os.path.join(build, 'images'), exist_ok=True)
+    for filename in sorted(os.listdir(source)):
+        if not filename.lower().endswith(IMAGE_TYPES):
+            continue
+        with Image.open(os.path.join(source, filename)) as original:
+            image = ImageOps.exif_transpose(original)
+            image.load()
+        width, height = image.size
+
+        # Only keep an alpha channel that something shows through
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = image.convert('RGBA')
+            if image.getchannel('A').getextrema()[0] == 255:
+                image = image.convert('RGB')
+        else:
+            image = image.convert('RGB')
+        fallback = ('PNG', '.png', 'image/png') if image.mode == 'RGBA' else ('JPEG', '.jpg', 'image/jpeg')
+
+        name = os.path.splitext(filename)[0]
+        variants = []
+        # A variant barely smaller than the full image isn't worth its bytes
+        widths = {w for w in IMAGE_WIDTHS if w < 0.9 * width} | {min(width, IMAGE_WIDTHS[-1])}
+        for w in sorted(widths):
+            h = round(height * w / width)
+            resized = image if w == width else image.resize((w, h), Image.LANCZOS)
+            for fmt, ext, mimetype in (('WEBP', '.webp', 'image/webp'), fallback):
+                data = _encode(resized, fmt)
+                path = 'images/' + _hashed_name(f"{name}.{w}", data, ext)
+                with open(os.path.join(build, path), 'wb') as f:
+                    f.write(data)
+                variants.append({'file': path, 'width': w, 'type': mimetype, 'bytes': len(data)})
+
+        images['images/' + filename] = {'width': width, 'height': height, 'variants': variants}
+    return images
+
+
+# Minifiers. Both only drop what can't change meaning: comments and
+# whitespace outside strings (and, in JS, regex literals). JS keeps its line
+# breaks so automatic semicolon insertion works as before.
+
+_WORD = re.compile(r'[\w$]')
+_REGEX_AFTER = set('(,=:[!&|?{};+-*%<>~^')
+_REGEX_KEYWORD = re.compile(r'(?<![\w$.])(?:return|typeof|case|do|else|in|of|void|yield)\s*$')
+
+
+def minify_js(source):
+    out = []
+    i, n = 0, len(source)
+    last = ''
+    while i < n:
+        c = source[i]
+        if c in '"\'`':
+            j = i + 1
+            while j < n and source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j+1])
+            last = c
+            i = j + 1
+        elif source.startswith('//', i):
+            while i < n and source[i] != '\n':
+                i += 1
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif c == '/' and (not last or last in _REGEX_AFTER or
+                           _REGEX_KEYWORD.search(''.join(out[-12:]))):
+            j, in_class = i + 1, False
+            while j < n and (in_class or source[j] != '/') and source[j] != '\n':
+                if source[j] == '\\':
+                    j += 1
+                elif source[j] == '[':
+                    in_class = True
+                elif source[j] == ']':
+                    in_class = False
+                j += 1
+            out.append(source[i:j+1])
+            last = '/'
+            i = j + 1
+        elif c in ' \t\r\n':
+            j = i
+            newline = False
+            while j < n and source[j] in ' \t\r\n':
+                newline |= source[j] == '\n'
+                j += 1
+            prev = out[-1][-1] if out else ''
+            nxt = source[j] if j < n else ''
+            if newline and prev and prev != '\n':
+                out.append('\n')
+            elif not newline and ((_WORD.match(prev) and _WORD.match(nxt)) or
+                                  (prev and prev == nxt and prev in '+-')):
+                out.append(' ')
+            i = j
+        else:
+            out.append(c)
+            last = c
+            i += 1
+    return ''.join(out).strip() + '\n'
+
+
+def minify_css(source):
+    out = []
+    i, n = 0, len(source)
+    while i < n:
+        c = source[i]
+        if c in '"\'':
+            j = i + 1
+            while j < n and source[j] != c:
+                j += 2 if source[j] == '\\' else 1
+            out.append(source[i:j+1])
+            i = j + 1
+        elif source.startswith('/*', i):
+            end = source.find('*/', i + 2)
+            i = n if end < 0 else end + 2
+        elif c.isspace():
+            while i < n and source[i].isspace():
+                i += 1
+            prev = out[-1][-1] if out else ''
+            nxt = source[i] if i < n else ''
+            if prev and prev not in '{};,:' and nxt not in '{};,':
+                out.append(' ')
+        else:
+            out.append(c)
+            i += 1
+    return ''.join(out).replace(';}', '}').strip() + '\n'
+
+
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def _write_hashed(build, path, data):
+    # Write data under build/ with a content hash in its name; returns the
+    # path relative to build/
+    name, ext = os.path.splitext(path)
+    hashed = _hashed_name(name, data, ext)
+    os.makedirs(os.path.dirname(os.path.join(build, hashed)), exist_ok=True)
+    with open(os.path.join(build, hashed), 'wb') as f:
+        f.write(data)
+    return hashed
+
+
+def _precompress(build, path, data):
+    # gzip and brotli copies of a built file, for Assets.send
+    written = []
+    with open(os.path.join(build, path + '.gz'), 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    written.append(path + '.gz')
+    if brotli is not None:
+        with open(os.path.join(build, path + '.br'), 'wb') as f:
+            f.write(brotli.compress(data))
+        written.append(path + '.br')
+    return written
+
+
+def build_bundles(static=STATIC_DIR, build=BUILD_DIR):
+    # Write the bundles; returns the manifest's "bundles" section (bundle
+    # name to file under build/) and every other file written
+    absent = [source for sources in BUNDLES.values() for source in sources
+              if not os.path.exists(os.path.join(static, source))]
+    if absent:
+        raise FileNotFoundError(f"Can't build the bundles: {', '.join(absent)} missing under {static}; "
+                                "run `python assets.py vendor`")
+    bundles, files = {}, []
+    for name, sources in BUNDLES.items():
+        parts = []
+        for source in sources:
+            with open(os.path.join(static, source), encoding='utf-8') as f:
+                text = f.read()
+            minified = source.endswith(('.min.js', '.min.css'))
+
+            if name.endswith('.css'):
+                if not minified:
+                    text = minify_css(text)
+                # Point url()s at built copies of what they name (or, for
+                # files that aren't there, where they were)
+                def rewrite(match, source=source):
+                    url = match.group(2).strip()
+                    if url.startswith(('data:', 'http:', 'https:', '/', '#')):
+                        return match.group(0)
+                    ref = urllib.parse.urlsplit(url)
+                    path = os.path.normpath(os.path.join(os.path.dirname(source), ref.path)).replace(os.sep, '/')
+                    try:
+                        with open(os.path.join(static, path), 'rb') as f:
+                            url = '/assets/' + _write_hashed(build, path, f.read())
+                        files.append(url[len('/assets/'):])
+                    except FileNotFoundError:
+                        url = '/static/' + path
+                    return f"url({url}{'#' + ref.fragment if ref.fragment else ''})"
+                parts.append(_CSS_URL.sub(rewrite, text))
+            else:
+                parts.append(text if minified else minify_js(text))
+
+        # A lone statement at the end of one script mustn't run into the next
+        joiner = '\n' if name.endswith('.css') else '\n;\n'
+        data = joiner.join(part.strip() for part in parts).encode('utf-8') + b'\n'
+        path = _write_hashed(build, name, data)
+        bundles[name] = path
+        files += [path] + _precompress(build, path, data)
+    return bundles, files
+
+
+def build(steps=('images', 'bundles'), build_dir=BUILD_DIR):
+    # Run build steps, keeping the manifest sections of the ones skipped
+    manifest = {}
+    try:
+        with open(os.path.join(build_dir, 'manifest.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        pass
+    os.makedirs(build_dir, exist_ok=True)
+
+    if 'images' in steps:
+        manifest['images'] = build_images(build=build_dir)
+    if 'bundles' in steps:
+        manifest['bundles'], manifest['files'] = build_bundles(build=build_dir)
+    with open(os.path.join(build_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    # Drop files from earlier builds
+    keep = {'manifest.json'} | set(manifest.get('files', []))
+    keep |= {v['file'] for entry in manifest.get('images', {}).values() for v in entry['variants']}
+    for root, _, filenames in os.walk(build_dir):
+        for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), build_dir).replace(os.sep, '/')
+            if path not in keep:
+                os.remove(os.path.join(root, filename))
+    return manifest
+
+
+def _fetch(url):
+    with urllib.request.urlopen(urllib.request.Request(url, headers={'User-Agent': USER_AGENT})) as response:
+        return response.read()
+
+
+def vendor(static=STATIC_DIR):
+    # Download the VENDOR files, and the fonts and images their CSS refers
+    # to, into static/
+    for path, url in VENDOR.items():
+        data = _fetch(url)
+        if path.endswith('.css'):
+            text = data.decode('utf-8')
+            def fetch_ref(match, path=path, url=url):
+                ref = match.group(2).strip()
+                if ref.startswith(('data:', '#')):
+                    return match.group(0)
+                ref_path = urllib.parse.urlsplit(ref).path
+                if urllib.parse.urlsplit(ref).scheme:
+                    # Absolute URLs (Google's font files) are stored next to the CSS
+                    local = os.path.join(os.path.dirname(path), os.path.basename(ref_path))
+                    ref = os.path.basename(ref_path)
+                else:
+                    local = os.path.normpath(os.path.join(os.path.dirname(path), ref_path))
+                os.makedirs(os.path.dirname(os.path.join(static, local)), exist_ok=True)
+                with open(os.path.join(static, local), 'wb') as f:
+                    f.write(_fetch(urllib.parse.urljoin(url, match.group(2).strip())))
+                return f"url({ref})"
+            data = _CSS_URL.sub(fetch_ref, text).encode('utf-8')
+        os.makedirs(os.path.dirname(os.path.join(static, path)), exist_ok=True)
+        with open(os.path.join(static, path), 'wb') as f:
+            f.write(data)
+        print(f"{path}: {len(data)} bytes from {url}")
+
+
+class Assets:
+    def __init__(self, app, manifest_path=MANIFEST_PATH):
+        self.manifest = {}
+        try:
+            with open(manifest_path, encoding='utf-8') as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            log.info("No asset manifest at %s; serving original files. Run `python assets.py`.",
+                     manifest_path)
+        self._images = {}
+        self._encoded = set(self.manifest.get('files', []))
+        absent = [source for source in VENDOR if not os.path.exists(os.path.join(STATIC_DIR, source))]
+        if absent and set(self.manifest.get('bundles', {})) != set(BUNDLES):
+            log.warning("Pages will load %s from CDNs: not vendored and not built. "
+                        "Run `python assets.py vendor` and `python assets.py`.", ', '.join(absent))
+
+        app.add_url_rule('/assets/<path:filename>', 'assets', self.send)
+        app.jinja_env.globals['image'] = self.image
+        app.jinja_env.globals['bundle'] = self.bundle
+
+    def send(self, filename):
+        # The precompressed copy the client takes, if there is one
+        accepted = request.accept_encodings
+        for encoding, suffix in ENCODINGS:
+            if filename + suffix in self._encoded and accepted[encoding]:
+                response = send_from_directory(BUILD_DIR, filename + suffix, max_age=IMMUTABLE_MAX_AGE,
+                                               mimetype=mimetypes.guess_type(filename)[0])
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(BUILD_DIR, filename, max_age=IMMUTABLE_MAX_AGE)
+        if any(filename + suffix in self._encoded for _, suffix in ENCODINGS):
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def bundle(self, name):
+        # URLs a page loads for a bundle: the built file, or else its
+        # sources, from the CDN for libraries not vendored yet
+        built = self.manifest.get('bundles', {}).get(name)
+        if built:
+            return ['/assets/' + built]
+        return [VENDOR[source] if source in VENDOR and not os.path.exists(os.path.join(STATIC_DIR, source))
+                else '/static/' + source
+                for source in BUNDLES[name]]
+
+    def image(self, url):
+        # {src, srcset, webp_srcset, width, height} for an image's original
+        # URL ("/static/images/door1.jpg"). The srcsets are empty, and src
+        # is the original, for images the build doesn't know.
+        found = self._images.get(url)
+        if found is None:
+            key = url[len('/static/'):] if url.startswith('/static/') else url
+            entry = self.manifest.get('images', {}).get(key)
+            if entry is None:
+                found = {'src': url, 'srcset': '', 'webp_srcset': '', 'width': None, 'height': None}
+            else:
+                def srcset(mimetype):
+                    return ', '.join(f"/assets/{v['file']} {v['width']}w"
+                                     for v in entry['variants'] if v['type'] == mimetype)
+                webp = [v for v in entry['variants'] if v['type'] == 'image/webp']
+                fallback = [v for v in entry['variants'] if v['type'] != 'image/webp']
+                # src is for browsers without srcset: the middle width will do
+                found = {
+                    'src': '/assets/' + fallback[min(1, len(fallback) - 1)]['file'],
+                    'srcset': srcset(fallback[0]['type']),
+                    'webp_srcset': srcset(webp[0]['type']),
+                    'width': entry['width'],
+                    'height': entry['height'],
+                }
+            self._images[url] = found
+        return found
+
+    def resolve(self, items, key):
+        # Copies of content dicts with the image under `key` resolved
+        # through the manifest: `key` becomes the fallback src and
+        # `<key>_srcset`, `<key>_webp_srcset` are added
+        resolved = []
+        for item in items:
+            image = self.image(item[key]) if item.get(key) else None
+            item = dict(item)
+            if image:
+                item[key] = image['src']
+                item[key + '_srcset'] = image['srcset']
+                item[key + '_webp_srcset'] = image['webp_srcset']
+            resolved.append(item)
+        return resolved
+
+
+if __name__ == '__main__':
+    # python assets.py [vendor] [images] [bundles]; images and bundles by default
+    steps = sys.argv[1:] or ['images', 'bundles']
+    if 'vendor' in steps:
+        vendor()
+        steps.remove('vendor')
+    if 'images' in steps:
+        try:
+            import PIL.Image
+        except ImportError:
+            sys.exit("Building images needs Pillow: pip install Pillow")
+    if steps:
+        logging.basicConfig(format='%(message)s')
+        try:
+            manifest = build(steps)
+        except FileNotFoundError as e:
+            sys.exit(str(e))
+        if 'images' in steps:
+            before = sum(os.path.getsize(os.path.join(STATIC_DIR, path)) for path in manifest['images'])
+            largest = sum(max(entry['variants'], key=lambda v: (v['width'], -v['bytes']))['bytes']
+                          for entry in manifest['images'].values())
+            print(f"{len(manifest['images'])} images: {before / 1e6:.1f} MB of originals, "
+                  f"{largest / 1e6:.1f} MB at their largest width in the smaller format")
+        if 'bundles' in steps:
+            for name, path in sorted(manifest['bundles'].items()):
+                size = os.path.getsize(os.path.join(BUILD_DIR, path))
+                packed = os.path.getsize(os.path.join(BUILD_DIR, path + '.gz'))
+                print(f"{name}: {size} bytes, {packed} gzipped")
+            if brotli is None:
+                print("brotli is not installed; only gzip copies were written")
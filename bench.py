@@ -0,0 +1,709 @@
+# Benchmarks: the rule helpers and validation, and every route over HTTP.
+#
+#   python bench.py [check] [micro] [http] [--out FILE] [--compare BASELINE]
+#   python bench.py --compare BASELINE RESULTS [--threshold 0.15]
+#
+# "micro" times is_facing, is_aligned, has_clear_view and full validation
+# (one layout at a time and vectorized) over a corpus drawn from a fixed
+# seed: random layouts of the required items in the default room, and
+# adversarial ones (crowded rooms full of walls and furniture, long
+# corridors where everything shares a line of sight, the largest room,
+# everything stacked on one cell). Each helper call gets a fresh
+# Sightlines per layout, as in a validation, so the first call on a layout
+# pays for the occupancy index.
+#
+# "http" sends requests to every route in server.py, from a pool of
+# threads, both through the app in-process (the Flask test client: routing
+# and views without sockets) and over loopback to a threaded werkzeug
+# server, and reports p50/p95/p99 latency and requests per second per
+# route. The app's instance folder (the gallery, the answer log, the
+# thumbnail files) is a temporary one, set before server.py is imported,
+# so the benchmarked app leaves instance/ alone; only the results are
+# written there. A route server.py gains without a request here is
+# reported as not benchmarked.
+#
+# "check" runs the fast paths (vectorized batches, ...) on layouts from
+# the same seed and counts the ones whose verdict differs from the rule
+# engine's own, RuleEngine.missing and RuleEngine.failed. The exit status
+# is 1 if any does.
+#
+# Results are written as JSON (instance/bench/<time>.json by default).
+# Keep one as a baseline and compare a later run against it. A route whose
+# p50 or p95 latency is more than `threshold` above the baseline's is
+# flagged as a regression, and so is a micro-benchmark whose median round
+# is (single calls are too noisy to go by). The exit status is 1 if there
+# are any. Compare results from the same machine only.
+
+import argparse
+import gc
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+import numpy as np
+
+import verdict_table
+from placement import engine
+from placement_batch import Rects, checks_for, failure_masks, validate_batch
+from rule_engine import MAX_ROOM_SIZE, has_clear_view, is_aligned, is_facing
+from sessions import SessionStore
+from visibility import Sightlines
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+RESULTS_DIR = os.path.join(ROOT, 'instance', 'bench')
+
+SEED = 20240501
+
+# Layouts in the corpus: random ones, and adversarial ones of each kind
+RANDOM_LAYOUTS = 2000
+ADVERSARIAL_LAYOUTS = 25
+
+# Passes over the corpus per micro-benchmark
+ROUNDS = 5
+
+# Helper calls timed per layout, at most
+MAX_PAIRS = 64
+
+# Requests per route, after WARMUP unmeasured ones, from CONCURRENCY threads
+REQUESTS = 200
+WARMUP = 20
+CONCURRENCY = 8
+
+# Layouts drawn for each equivalence check, on top of the corpus, and
+# validation sessions driven by CHECK_DELTAS random deltas each
+CHECK_LAYOUTS = 2000
+CHECK_ROOMS = 40
+CHECK_SESSIONS = 30
+CHECK_DELTAS = 100
+
+# Seconds to wait for background work to finish before timing routes
+SETTLE_TIMEOUT = 60
+
+# Relative slowdown of p50 or p95 flagged by --compare
+THRESHOLD = 0.15
+
+
+# Corpus
+
+def _spot(rng, rows, cols, height, width):
+    return {'row': rng.randrange(rows - height + 1), 'col': rng.randrange(cols - width + 1),
+            'height': height, 'width': width}
+
+def _item(rng, kind, rows, cols):
+    height, width = engine.footprint(kind)
+    if rng.random() < 0.25 and width <= rows and height <= cols:
+        height, width = width, height
+    return _spot(rng, rows, cols, height, width)
+
+def _walls(rng, rows, cols, count):
+    return [_spot(rng, rows, cols, rng.randint(1, max(1, rows // 8)), rng.randint(1, max(1, cols // 8)))
+            for _ in range(count)]
+
+def random_layout(rng):
+    # The required items anywhere in the default room
+    room = engine.room
+    return {kind: _item(rng, kind, room.rows, room.cols) for kind in engine.required}
+
+def crowded_layout(rng, size=64):
+    # Many walls, and many of every item, so every pairwise rule checks
+    # lots of pairs through a cluttered room
+    placement = {'room': {'rows': size, 'cols': size, 'walls': _walls(rng, size, size, size // 2)}}
+    for kind in engine.objects:
+        placement[kind] = [_item(rng, kind, size, size) for _ in range(size // 4)]
+    return placement
+
+def corridor_layout(rng, length=MAX_ROOM_SIZE):
+    # A two-row room where everything shares rows with everything else,
+    # so every pair is in a band and needs a line-of-sight test
+    placement = {'room': {'rows': 2, 'cols': length, 'walls': _walls(rng, 1, length, length // 32)}}
+    for kind in engine.objects:
+        height, width = engine.footprint(kind)
+        if height > 2:
+            height, width = width, height
+        placement[kind] = [_spot(rng, 2, length, height, width) for _ in range(16)]
+    return placement
+
+def largest_room_layout(rng):
+    # The required items far apart in the largest room allowed
+    size = MAX_ROOM_SIZE
+    return {'room': {'rows': size, 'cols': size, 'walls': _walls(rng, size, size, 64)},
+            **{kind: _item(rng, kind, size, size) for kind in engine.required}}
+
+def stacked_layout(rng):
+    # Every item on the same cells
+    room = engine.room
+    row, col = rng.randrange(room.rows - 2), rng.randrange(room.cols - 2)
+    placement = {}
+    for kind in engine.objects:
+        height, width = engine.footprint(kind)
+        placement[kind] = [{'row': row, 'col': col, 'height': height, 'width': width}] * 3
+    return placement
+
+ADVERSARIAL = {
+    'crowded': crowded_layout,
+    'corridor': corridor_layout,
+    'largest_room': largest_room_layout,
+    'stacked': stacked_layout,
+}
+
+def corpus(seed=SEED, random_count=RANDOM_LAYOUTS, adversarial_count=ADVERSARIAL_LAYOUTS):
+    # {"random": [placement, ...], "adversarial": [...]}, the same for a seed
+    rng = random.Random(seed)
+    return {
+        'random': [random_layout(rng) for _ in range(random_count)],
+        'adversarial': [make(rng) for make in ADVERSARIAL.values() for _ in range(adversarial_count)],
+    }
+
+
+# Statistics
+
+def summary(samples, total=None):
+    # Latency percentiles in microseconds, and throughput; `total` is the
+    # wall time the samples were taken over, if they overlapped
+    samples = sorted(samples)
+    n = len(samples)
+    if not n:
+        return {'count': 0}
+    spent = total if total is not None else sum(samples)
+    def at(q):
+        return round(samples[min(n - 1, int(q * n))] * 1e6, 2)
+    return {
+        'count': n,
+        'mean_us': round(sum(samples) / n * 1e6, 2),
+        'p50_us': at(0.50),
+        'p95_us': at(0.95),
+        'p99_us': at(0.99),
+        'per_second': round(n / spent, 1) if spent else None,
+    }
+
+
+# Micro-benchmarks
+
+def _pairs(by_type, first, second):
+    pairs = [(a, b) for a in by_type.get(first, []) for b in by_type.get(second, []) if a != b]
+    return pairs[:MAX_PAIRS]
+
+# Distance of the room definition's clear-view rule
+VIEW_DISTANCE = next(spec['distance'] for spec in engine.definition['rules'] if spec['check'] == 'clear_view')
+
+HELPERS = {
+    # name: (items, call)
+    'is_facing': (('mirror', 'bed'), is_facing),
+    'is_aligned': (('bed', 'door'), is_aligned),
+    'has_clear_view': (('desk', 'door'), lambda room, a, b, sight: has_clear_view(room, a, b, VIEW_DISTANCE, sight)),
+}
+
+def micro_summary(rounds):
+    # summary() of every call, plus `round_us`: the median over rounds of
+    # the mean call, steadier than any one call's percentile and what
+    # --compare goes by
+    result = summary([elapsed for samples in rounds for elapsed in samples])
+    means = sorted(sum(samples) / len(samples) for samples in rounds if samples)
+    if means:
+        result['round_us'] = round(means[len(means) // 2] * 1e6, 2)
+    return result
+
+def bench_helper(layouts, items, call, rounds):
+    perf_counter = time.perf_counter
+    results = []
+    for _ in range(rounds):
+        samples = []
+        for room, by_type in layouts:
+            sight = Sightlines(room, by_type)
+            for a, b in _pairs(by_type, *items):
+                start = perf_counter()
+                call(room, a, b, sight)
+                samples.append(perf_counter() - start)
+        results.append(samples)
+    return micro_summary(results)
+
+def bench_validate(placements, rounds):
+    perf_counter = time.perf_counter
+    validate = engine.validate
+    results = []
+    for _ in range(rounds):
+        samples = []
+        for placement in placements:
+            start = perf_counter()
+            validate(placement)
+            samples.append(perf_counter() - start)
+        results.append(samples)
+    return micro_summary(results)
+
+def bench_batch(placements, rounds):
+    # Time per layout of validating them all in one batch
+    results = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        validate_batch(placements)
+        results.append([(time.perf_counter() - start) / len(placements)])
+    result = micro_summary(results)
+    result['count'] = len(placements) * rounds
+    return result
+
+def micro(layouts, rounds=ROUNDS):
+    # Collections would land on whichever call happened to trigger them
+    gc.collect()
+    gc.disable()
+    try:
+        return _micro(layouts, rounds)
+    finally:
+        gc.enable()
+
+def _micro(layouts, rounds):
+    results = {}
+    for group, placements in layouts.items():
+        parsed = [engine.parse(placement) for placement in placements]
+        for name, (items, call) in HELPERS.items():
+            results[f'{name}/{group}'] = bench_helper(parsed, items, call, rounds)
+        results[f'validate/{group}'] = bench_validate(placements, rounds)
+    results['validate_batch/random'] = bench_batch(layouts['random'], rounds)
+    for name, result in results.items():
+        _report(name, result)
+    return results
+
+
+# Equivalence checks. Each takes the corpus and a seeded Random and returns
+# (layouts whose verdict differs from the rule engine's, layouts checked).
+
+def verdict(room, by_type):
+    # (missing, failed) as the rule engine has it; rules aren't checked
+    # while items are missing
+    missing = engine.missing(by_type)
+    return missing, 0 if missing else engine.failed(room, by_type)
+
+def check_batch(layouts, rng):
+    # validate_batch's responses, vectorized or not, with some of the
+    # required items left out
+    placements = layouts['random'] + layouts['adversarial']
+    placements += [{kind: spec for kind, spec in random_layout(rng).items() if rng.random() > 0.1}
+                   for _ in range(CHECK_LAYOUTS)]
+    results = validate_batch(placements)
+    differ = sum(result != engine.feedback(*verdict(*engine.parse(placement)))
+                 for placement, result in zip(placements, results))
+    return differ, len(placements)
+
+def check_verdict_table(layouts, rng):
+    # Lookups in the built verdict table, on layouts of the default
+    # footprints anywhere on the grid; checks nothing without a current one
+    table = verdict_table.load()
+    if table is None:
+        print(f"No current verdict table at {verdict_table.DEFAULT_PATH}; run `python verdict_table.py`")
+        return 0, 0
+    room = engine.room
+    placements = layouts['random'] + [
+        {kind: {'row': rng.randrange(room.rows), 'col': rng.randrange(room.cols)} for kind in engine.required}
+        for _ in range(CHECK_LAYOUTS)]
+    differ, count = 0, 0
+    try:
+        for placement in placements:
+            failed = table.lookup(placement)
+            if failed is None:
+                continue
+            count += 1
+            differ += (0, failed) != verdict(*engine.parse(placement))
+    finally:
+        table.close()
+    return differ, count
+
+def check_sessions(layouts, rng):
+    # Validation sessions after every update, one to three deltas at a
+    # time, in crowded rooms of a few sizes
+    store = SessionStore(engine)
+    differ, count = 0, 0
+    for _ in range(CHECK_SESSIONS):
+        size = rng.choice([8, 16, 32])
+        placement = crowded_layout(rng, size)
+        items = [{'id': f'{kind}{i}', 'type': kind, **spec}
+                 for kind in engine.objects for i, spec in enumerate(placement[kind])]
+        _, session = store.create({'room': placement['room'], 'items': items})
+        # {id: type} of the items placed once the deltas so far apply
+        placed, added = {item['id']: item['type'] for item in items}, 0
+        for _ in range(CHECK_DELTAS):
+            deltas = []
+            for _ in range(rng.randint(1, 3)):
+                action = rng.random()
+                if action < 0.6 and placed:
+                    item_id = rng.choice(list(placed))
+                    deltas.append({'op': 'move', 'id': item_id, **_item(rng, placed[item_id], size, size)})
+                elif action < 0.8 or not placed:
+                    kind = rng.choice(list(engine.objects))
+                    added += 1
+                    placed[added] = kind
+                    deltas.append({'op': 'add', 'id': added, 'type': kind, **_item(rng, kind, size, size)})
+                else:
+                    item_id = rng.choice(list(placed))
+                    del placed[item_id]
+                    deltas.append({'op': 'remove', 'id': item_id})
+            session.update(deltas)
+            count += 1
+            # Sessions keep their failed rules up to date while items are missing too
+            room, by_type = session.room, session.by_type
+            differ += (session.missing, session.failed) != (engine.missing(by_type), engine.failed(room, by_type))
+    return differ, count
+
+def check_sightlines(layouts, rng):
+    # failure_masks, whose line-of-sight tests are vectorized, in small
+    # rooms with walls, the required items anywhere in them and free to
+    # overlap each other and the walls
+    differ, count = 0, 0
+    for _ in range(CHECK_ROOMS):
+        rows, cols = rng.randint(2, 12), rng.randint(2, 12)
+        room = engine.room_for({'rows': rows, 'cols': cols,
+                                'walls': _walls(rng, rows, cols, rng.randint(0, 4))})
+        placed = []
+        for _ in range(CHECK_LAYOUTS // CHECK_ROOMS):
+            layout = []
+            for kind in engine.required:
+                height, width = engine.footprint(kind)
+                if rng.random() < 0.3:
+                    height, width = width, height
+                layout.append(_spot(rng, rows, cols, min(height, rows), min(width, cols)))
+            placed.append(layout)
+        values = np.array([[(spec['row'], spec['col'], spec['height'], spec['width']) for spec in layout]
+                           for layout in placed])
+        masks = failure_masks(Rects(*(values[:, :, f] for f in range(4))), checks_for(room))
+        for layout, mask in zip(placed, masks.tolist()):
+            by_type = {kind: [engine.item(room, kind, spec)] for kind, spec in zip(engine.required, layout)}
+            differ += mask != engine.failed(room, by_type)
+            count += 1
+    return differ, count
+
+EQUIVALENCE = {
+    'validate_batch': check_batch,
+    'verdict_table': check_verdict_table,
+    'validation_sessions': check_sessions,
+    'vectorized_sightlines': check_sightlines,
+}
+
+def check(layouts, seed=SEED):
+    results = {}
+    for name, run in EQUIVALENCE.items():
+        differ, count = run(layouts, random.Random(seed))
+        results[name] = {'count': count, 'differ': differ}
+        if count:
+            print(f"{name}: {differ} of {count} layouts differ from the rule engine")
+        else:
+            print(f"{name}: skipped")
+    return results
+
+
+# HTTP
+
+def sandbox(folder):
+    # The app, with `folder` as its instance folder. server.py opens its
+    # stores as it's imported, so it mustn't have been imported already.
+    if 'server' in sys.modules:
+        raise RuntimeError("server was imported before the benchmark could move its instance folder")
+    os.environ['FENGSHUIFY_INSTANCE_PATH'] = os.path.abspath(folder)
+    import server
+    return server
+
+def settle(server, timeout=SETTLE_TIMEOUT):
+    # Wait for the challenge pools to fill, so the generator thread isn't
+    # competing with the requests being timed
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = server.challenges.stats()
+        if all(ready >= stats['pool_size'] for ready in stats['ready'].values()):
+            return
+        time.sleep(0.2)
+    print(f"Challenge pools still filling after {timeout}s; timings may be noisy")
+
+def _request(method, path, json_body=None, form=None, body=None, content_type=None):
+    # (method, path, body bytes, content type), as sent by either client
+    if json_body is not None:
+        return method, path, json.dumps(json_body).encode(), 'application/json'
+    if form is not None:
+        return method, path, urlencode(form).encode(), 'application/x-www-form-urlencoded'
+    return method, path, body, content_type
+
+def requests_for(server, layouts, count):
+    # {endpoint: function(i) -> request} for every route. Sets up what the
+    # requests need (sessions, a saved layout) through the app itself.
+    app = server.app
+    client = app.test_client()
+    rng = random.Random(SEED)
+    placements = layouts['random']
+    def layout(i):
+        return placements[i % len(placements)]
+
+    bank = server.quiz_bank
+    answers = {q.id: bank.key[i] for i, q in enumerate(bank.questions)}
+    submissions = '\n'.join(json.dumps({'id': n, 'answers': answers}) for n in range(100)).encode()
+
+    def new_session(i):
+        items = [{'id': kind, 'type': kind, **spec} for kind, spec in layout(i).items()]
+        return client.post('/validation_sessions', json={'items': items}).get_json()['session']
+    session = new_session(0)
+    doomed = [new_session(i) for i in range(count)]
+    mirror = layout(0)['mirror']
+
+    saved = client.post('/gallery', json=layout(0)).get_json()['id']
+    bundles = server.assets.manifest.get('bundles', {})
+
+    requests = {
+        'static': lambda i: _request('GET', '/static/css/style.css'),
+        'home': lambda i: _request('GET', '/'),
+        'learn_overview': lambda i: _request('GET', '/learn/overview'),
+        'learn': lambda i: _request('GET', f'/learn/{i % (len(server.lessons) + 1) + 1}'),
+        'quiz': lambda i: _request('GET', '/quiz'),
+        'mini_simulator': lambda i: _request('GET', '/mini_simulator/1'),
+        'simulator': lambda i: _request('GET', '/simulator'),
+        'about': lambda i: _request('GET', '/about'),
+        'orientation_game': lambda i: _request('GET', f'/orientation_game/{i % len(server.orientation_games) + 1}'),
+        'check_orientation': lambda i: _request('POST', '/check_orientation',
+                                                form={'section': '1', 'choice': 'abc'[i % 3]}),
+        'submit_quiz': lambda i: _request('POST', '/submit_quiz', form=answers),
+        'quiz_questions': lambda i: _request('GET', f'/quiz/questions?count=5&seed={i}'),
+        'grade_quizzes': lambda i: _request('POST', '/quiz/grade', body=submissions,
+                                            content_type='application/x-ndjson'),
+        'validate_placement': lambda i: _request('POST', '/validate_placement', json_body=layout(i)),
+        'validate_placement_batch': lambda i: _request('POST', '/validate_placement/batch',
+                                                       json_body=placements[:100]),
+        'create_validation_session': lambda i: _request(
+            'POST', '/validation_sessions',
+            json_body={'items': [{'id': kind, 'type': kind, **spec} for kind, spec in layout(i).items()]}),
+        'get_validation_session': lambda i: _request('GET', f'/validation_sessions/{session}'),
+        'update_validation_session': lambda i: _request(
+            'POST', f'/validation_sessions/{session}/deltas',
+            json_body={'op': 'move', 'id': 'mirror', 'row': mirror['row'], 'col': (mirror['col'] + i % 2) % 7}),
+        'delete_validation_session': lambda i: _request('DELETE', f'/validation_sessions/{doomed[i % count]}'),
+        'qi_flow_heatmap': lambda i: _request('POST', '/qi_flow', json_body=layout(i)),
+        'suggest_fix': lambda i: _request('POST', '/validate_placement/fix', json_body=layout(i)),
+        'save_layout': lambda i: _request('POST', '/gallery', json_body=layout(i)),
+        'list_layouts': lambda i: _request('GET', '/gallery?limit=20'),
+        'get_layout': lambda i: _request('GET', f'/gallery/{saved}'),
+        'layout_thumbnail': lambda i: _request(
+            'GET', '/thumbnail.png?' + urlencode({'layout': json.dumps(layout(i)), 'overlay': 1})),
+        'saved_layout_thumbnail': lambda i: _request('GET', f'/gallery/{saved}/thumbnail.png'),
+        'analytics_stats': lambda i: _request('GET', '/analytics/stats'),
+        'challenge_stats': lambda i: _request('GET', '/challenges/stats'),
+        'metrics_page': lambda i: _request('GET', '/metrics'),
+        'healthz': lambda i: _request('GET', '/healthz'),
+    }
+    if bundles:
+        path = sorted(bundles.values())[0]
+        requests['assets'] = lambda i: _request('GET', f'/assets/{path}')
+    # Last, as taking challenges sets the generator off again
+    requests['get_challenge'] = lambda i: _request('GET', f"/challenges/{rng.choice(['easy', 'medium', 'hard'])}")
+    return requests
+
+def _route_names(app):
+    # "METHOD /rule" per endpoint, for the report
+    names = {}
+    for rule in app.url_map.iter_rules():
+        methods = sorted(rule.methods - {'HEAD', 'OPTIONS'})
+        names[rule.endpoint] = f"{' '.join(methods)} {rule.rule}"
+    return names
+
+def in_process(app):
+    # A sender per thread through the test client
+    local = threading.local()
+    def send(method, path, body, content_type):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        response = client.open(path, method=method, data=body, content_type=content_type)
+        response.get_data()
+        response.close()
+        return response.status_code
+    return send
+
+def loopback(port):
+    # A sender over a new connection per request, like the HTTP/1.0 server
+    import http.client
+    def send(method, path, body, content_type):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            connection.request(method, path, body=body, headers={'Content-Type': content_type} if content_type else {})
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        finally:
+            connection.close()
+    return send
+
+def load(send, make_request, count=REQUESTS, concurrency=CONCURRENCY, warmup=WARMUP):
+    # Latency summary and status counts of `count` requests
+    for i in range(warmup):
+        send(*make_request(count + i))
+
+    requests = [make_request(i) for i in range(count)]
+    def one(request):
+        start = time.perf_counter()
+        status = send(*request)
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        timings = list(pool.map(one, requests))
+    total = time.perf_counter() - start
+
+    result = summary([elapsed for elapsed, _ in timings], total)
+    statuses = {}
+    for _, status in timings:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    result['statuses'] = statuses
+    return result
+
+def http(layouts, modes=('in_process', 'loopback'), count=REQUESTS, concurrency=CONCURRENCY, only=None):
+    from werkzeug.serving import make_server
+
+    # The loopback server's access log would cost more than some routes
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        server = sandbox(folder)
+        app = server.app
+        # Failing routes are reported by status below, not by traceback
+        app.logger.setLevel(logging.CRITICAL)
+        names = _route_names(app)
+        # Deletes need a session each, warmup included
+        requests = requests_for(server, layouts, (count + WARMUP) * len(modes))
+        missing = sorted(names[endpoint] for endpoint in names if endpoint not in requests)
+        if missing:
+            print("Not benchmarked:", ', '.join(missing))
+
+        for mode in modes:
+            if mode == 'loopback':
+                httpd = make_server('127.0.0.1', 0, app, threaded=True)
+                threading.Thread(target=httpd.serve_forever, daemon=True).start()
+                send = loopback(httpd.server_port)
+            else:
+                httpd, send = None, in_process(app)
+            offset = 0 if mode == modes[0] else count + WARMUP
+            settle(server)
+            try:
+                for endpoint, make_request in requests.items():
+                    name = names[endpoint]
+                    if only and only not in name:
+                        continue
+                    result = load(send, lambda i: make_request(i + offset), count, concurrency)
+                    results[f'{mode}/{name}'] = result
+                    _report(f'{mode} {name}', result)
+            finally:
+                if httpd is not None:
+                    httpd.shutdown()
+        server.answer_log.flush()
+
+    failing = sorted(name for name, result in results.items()
+                     if any(status.startswith('5') for status in result['statuses']))
+    if failing:
+        print("Server errors from:", ', '.join(failing))
+    return results
+
+
+# Results
+
+def _report(name, result):
+    if not result.get('count'):
+        print(f"{name}: no samples")
+        return
+    statuses = result.get('statuses')
+    line = (f"{name}: p50 {result['p50_us']:.1f}us  p95 {result['p95_us']:.1f}us  "
+            f"p99 {result['p99_us']:.1f}us  {result['per_second']:.0f}/s")
+    if statuses:
+        line += '  ' + ' '.join(f"{status}x{n}" for status, n in sorted(statuses.items()))
+    print(line)
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'seed': SEED,
+    }
+
+def compare(baseline, results, threshold=THRESHOLD):
+    # Print every benchmark in both with its change; returns the names of
+    # those that got slower by more than `threshold`. Micro-benchmarks go
+    # by round_us, routes by p50 and p95.
+    regressions = []
+    for section in ('micro', 'http'):
+        before, after = baseline.get(section, {}), results.get(section, {})
+        for name in sorted(before.keys() & after.keys()):
+            old, new = before[name], after[name]
+            if not old.get('count') or not new.get('count'):
+                continue
+            measures = ('round_us',) if 'round_us' in old and 'round_us' in new else ('p50_us', 'p95_us')
+            changes = {m: new[m] / old[m] - 1 for m in measures if old[m]}
+            slower = any(change > threshold for change in changes.values())
+            if slower:
+                regressions.append(f'{section}/{name}')
+            faster = changes and all(change < -threshold for change in changes.values())
+            flag = '  REGRESSION' if slower else '  faster' if faster else ''
+            print(f"{section}/{name}: " +
+                  '  '.join(f"{m[:-3]} {old[m]:.1f} -> {new[m]:.1f}us ({change:+.0%})"
+                            for m, change in changes.items()) + flag)
+    print(f"{len(regressions)} regression(s) beyond {threshold:.0%}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rule helpers, validation and every route.")
+    parser.add_argument('parts', nargs='*', metavar='check|micro|http', help="what to run (all three by "
+                        "default, unless only comparing files)")
+    parser.add_argument('--out', help="results file (default: instance/bench/<time>.json)")
+    parser.add_argument('--compare', nargs='+', metavar='FILE',
+                        help="baseline to compare this run against, or a baseline and a results file")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help="relative slowdown flagged")
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--rounds', type=int, default=ROUNDS, help="passes over the corpus per micro-benchmark")
+    parser.add_argument('--requests', type=int, default=REQUESTS, help="requests per route")
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--mode', choices=['in_process', 'loopback', 'both'], default='both')
+    parser.add_argument('--routes', help="only routes whose 'METHOD /rule' contains this")
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) == 2 and not args.parts:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            sys.exit(1 if compare(json.load(f), json.load(g), args.threshold) else 0)
+    if args.compare and len(args.compare) > 2:
+        parser.error("--compare takes a baseline, or a baseline and a results file")
+    if set(args.parts) - {'check', 'micro', 'http'}:
+        parser.error("parts are check, micro and http")
+    parts = args.parts or ['check', 'micro', 'http']
+
+    layouts = corpus(args.seed)
+    results = {'environment': {**environment(), 'seed': args.seed}}
+    if 'check' in parts:
+        results['check'] = check(layouts, args.seed)
+    if 'micro' in parts:
+        results['micro'] = micro(layouts, args.rounds)
+    if 'http' in parts:
+        modes = ('in_process', 'loopback') if args.mode == 'both' else (args.mode,)
+        results['http'] = http(layouts, modes, args.requests, args.concurrency, args.routes)
+
+    out = args.out or os.path.join(RESULTS_DIR, time.strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print("Results written to", out)
+
+    failed = any(result['differ'] for result in results.get('check', {}).values())
+    if failed:
+        print("Fast paths disagree with the rule engine")
+    if args.compare:
+        with open(args.compare[0]) as f:
+            failed = compare(json.load(f), results, args.threshold) or failed
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
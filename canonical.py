@@ -0,0 +1,82 @@
+# Canonical form of a layout under the symmetries of the grid.
+#
+# Rotating or reflecting a room doesn't change whether it follows the rules
+# or how qì moves through it, so results can be cached once for all eight
+# orientations. canonical() picks the smallest of the eight transformed
+# layouts as the representative and reports which transform produced it.
+
+import hashlib
+from collections import namedtuple
+
+import numpy as np
+
+Canonical = namedtuple('Canonical', 'digest transform rows cols walls items')
+
+# Transforms of a (row, col, height, width) rectangle in a rows x cols room.
+# 1 and 3 rotate a quarter turn clockwise and anticlockwise, 2 a half turn,
+# 4 and 5 mirror left-right and top-bottom, 6 and 7 reflect across the
+# diagonals. The odd ones out (1, 3, 6, 7) swap the room's sides.
+TRANSFORMS = 8
+_SWAPS_SIDES = (False, True, False, True, False, False, True, True)
+INVERSE = (0, 3, 2, 1, 4, 5, 6, 7)
+
+
+def transform_rect(t, rows, cols, rect):
+    r, c, h, w = rect
+    if t == 0:
+        return (r, c, h, w)
+    if t == 1:
+        return (c, rows - r - h, w, h)
+    if t == 2:
+        return (rows - r - h, cols - c - w, h, w)
+    if t == 3:
+        return (cols - c - w, r, w, h)
+    if t == 4:
+        return (r, cols - c - w, h, w)
+    if t == 5:
+        return (rows - r - h, c, h, w)
+    if t == 6:
+        return (c, r, w, h)
+    return (cols - c - w, rows - r - h, w, h)
+
+
+def transform_grid(t, grid):
+    # Apply transform t to an array indexed [row, col]
+    if t == 0:
+        return grid
+    if t == 1:
+        return np.rot90(grid, -1)
+    if t == 2:
+        return np.rot90(grid, 2)
+    if t == 3:
+        return np.rot90(grid, 1)
+    if t == 4:
+        return grid[:, ::-1]
+    if t == 5:
+        return grid[::-1, :]
+    if t == 6:
+        return grid.T
+    return np.rot90(grid, 2).T
+
+
+def transformed(t, room, by_type):
+    # The layout as (rows, cols, walls, items) after transform t, with walls
+    # and items sorted so equal layouts compare equal
+    rows, cols = room.rows, room.cols
+    walls = tuple(sorted(transform_rect(t, rows, cols, wall) for wall in room.walls))
+    items = tuple(sorted(
+        (kind,) + transform_rect(t, rows, cols, (item.row, item.col, item.height, item.width))
+        for kind, placed in by_type.items() for item in placed))
+    if _SWAPS_SIDES[t]:
+        rows, cols = cols, rows
+    return rows, cols, walls, items
+
+
+def canonical(room, by_type):
+    best, best_t = None, 0
+    for t in range(TRANSFORMS):
+        form = transformed(t, room, by_type)
+        if best is None or form < best:
+            best, best_t = form, t
+    digest = hashlib.sha256(repr(best).encode()).hexdigest()
+    return Canonical(digest, best_t, *best)
@@ -0,0 +1,320 @@
+# Saved simulator layouts, for sharing and the gallery.
+#
+# A layout is stored once for all eight rotations and reflections of its
+# room: it is keyed by its canonical digest (see canonical.py), so saving a
+# mirrored copy of a saved layout returns the existing one. The canonical
+# form is bit-packed (see pack), about a dozen bytes for a default room, and
+# the transform of whoever saved it first is kept to hand it back the way
+# they drew it.
+#
+# Packed layouts name item types by their place in the gallery's own table
+# of types and default footprints, kept in the meta table. Types the
+# definition gains are added to its end, and nothing in it ever changes,
+# so reordering, adding or resizing objects in the definition doesn't
+# change what saved layouts mean.
+#
+# Each row carries its verdict (missing-item and failed-rule masks, and
+# whether it passes), computed when it is saved. The gallery is listed
+# newest first with keyset pagination on the row id, through an index on
+# (valid, id), so every page is one index range scan however deep it is.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from canonical import INVERSE, canonical, transform_rect
+from rule_engine import MAX_ROOM_SIZE
+
+log = logging.getLogger(__name__)
+
+DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'gallery.sqlite3')
+
+# Layouts per gallery page, by default and at most
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# Largest layouts accepted, in walls and items
+MAX_WALLS = 256
+MAX_ITEMS = 256
+
+# Layouts re-checked per transaction when the rules have changed
+RECHECK_BATCH = 10000
+
+# Item types the gallery's table can hold
+MAX_KINDS = 256
+
+# Bits for a room side (stored minus one), for a count of walls or items,
+# and for an item type
+_SIDE_BITS = (MAX_ROOM_SIZE - 1).bit_length()
+_COUNT_BITS = max(MAX_WALLS, MAX_ITEMS).bit_length()
+_KIND_BITS = (MAX_KINDS - 1).bit_length()
+
+# Item footprints: the type's default, the default turned, or stored
+_DEFAULT, _TURNED, _STORED = range(3)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS layouts (
+    id INTEGER PRIMARY KEY,
+    digest BLOB NOT NULL UNIQUE,
+    layout BLOB NOT NULL,
+    transform INTEGER NOT NULL,
+    valid INTEGER NOT NULL,
+    missing INTEGER NOT NULL,
+    failed INTEGER NOT NULL,
+    saved REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS layouts_by_verdict ON layouts (valid, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL
+);
+'''
+
+
+def pack(kinds, rows, cols, walls, items):
+    # Bit-pack a canonical layout. `kinds` is the table of item types, as
+    # [(type, (height, width)), ...]. Coordinates take as many bits as the
+    # room's sides need, item types are indexes into the table, and
+    # footprints take two bits unless they differ from the table's.
+    index = {kind: i for i, (kind, _) in enumerate(kinds)}
+    footprints = dict(kinds)
+    row_bits, col_bits = (rows - 1).bit_length(), (cols - 1).bit_length()
+    value, size = 0, 0
+
+    def put(field, bits):
+        nonlocal value, size
+        value |= field << size
+        size += bits
+
+    put(rows - 1, _SIDE_BITS)
+    put(cols - 1, _SIDE_BITS)
+    put(len(walls), _COUNT_BITS)
+    for row, col, height, width in walls:
+        put(row, row_bits)
+        put(col, col_bits)
+        put(height - 1, row_bits)
+        put(width - 1, col_bits)
+    put(len(items), _COUNT_BITS)
+    for kind, row, col, height, width in items:
+        put(index[kind], _KIND_BITS)
+        put(row, row_bits)
+        put(col, col_bits)
+        footprint = footprints[kind]
+        if (height, width) == footprint:
+            put(_DEFAULT, 2)
+        elif (width, height) == footprint:
+            put(_TURNED, 2)
+        else:
+            put(_STORED, 2)
+            put(height - 1, row_bits)
+            put(width - 1, col_bits)
+    return value.to_bytes((size + 7) // 8, 'little')
+
+
+def unpack(kinds, data):
+    # (rows, cols, walls, items) as packed with the same table of types.
+    # Raises ValueError for data it can't have packed.
+    value = int.from_bytes(data, 'little')
+
+    def take(bits):
+        nonlocal value
+        field = value & ((1 << bits) - 1)
+        value >>= bits
+        return field
+
+    rows, cols = take(_SIDE_BITS) + 1, take(_SIDE_BITS) + 1
+    row_bits, col_bits = (rows - 1).bit_length(), (cols - 1).bit_length()
+    walls = tuple((take(row_bits), take(col_bits), take(row_bits) + 1, take(col_bits) + 1)
+                  for _ in range(take(_COUNT_BITS)))
+    items = []
+    for _ in range(take(_COUNT_BITS)):
+        i = take(_KIND_BITS)
+        if i >= len(kinds):
+            raise ValueError(f"Unknown item type {i}")
+        kind, (height, width) = kinds[i]
+        row, col = take(row_bits), take(col_bits)
+        footprint = take(2)
+        if footprint == _STORED:
+            height, width = take(row_bits) + 1, take(col_bits) + 1
+        elif footprint == _TURNED:
+            height, width = width, height
+        items.append((kind, row, col, height, width))
+    return rows, cols, walls, tuple(items)
+
+
+class Gallery:
+    def __init__(self, engine, path=DB_PATH):
+        self.engine = engine
+        self.path = path
+        self._local = threading.local()
+        # The table of item types packed layouts refer to, see pack
+        self._kinds = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._load_kinds()
+        self._recheck()
+
+    def _db(self):
+        # One connection per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+        return db
+
+    def _verdict(self, room, by_type):
+        engine = self.engine
+        missing = engine.missing(by_type)
+        failed = engine.failed(room, by_type)
+        return (not missing and not failed), missing, failed
+
+    def _load_kinds(self):
+        # Read the table of item types, adding the definition's new ones to
+        # its end
+        db = self._db()
+        with db:
+            # Taken for writing up front, so two processes starting at once
+            # can't both add a type at the same place
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute("SELECT value FROM meta WHERE key = 'objects'").fetchone()
+            kinds = [(kind, (height, width)) for kind, height, width in json.loads(row[0])] if row else []
+            known = {kind for kind, _ in kinds}
+            added = [(kind, self.engine.footprint(kind)) for kind in self.engine.objects if kind not in known]
+            if len(kinds) + len(added) > MAX_KINDS:
+                raise ValueError(f"Saved layouts can use at most {MAX_KINDS} item types")
+            if added or row is None:
+                kinds += added
+                db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('objects', ?)",
+                           (json.dumps([[kind, height, width] for kind, (height, width) in kinds]),))
+        self._kinds = kinds
+
+    def _unpack(self, data):
+        try:
+            return unpack(self._kinds, data)
+        except ValueError:
+            # Saved by a process that has since added types to the table
+            self._load_kinds()
+            return unpack(self._kinds, data)
+
+    def _recheck(self):
+        # Saved verdicts are only good for the rules they were computed
+        # with: re-check every layout once the rules change. Layouts that
+        # can't be read under the new rules keep their old verdict.
+        db = self._db()
+        row = db.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+        if row is not None and row[0] == self.engine.version:
+            return
+        after, count, skipped = 0, 0, 0
+        while True:
+            batch = db.execute('SELECT id, layout FROM layouts WHERE id > ? ORDER BY id LIMIT ?',
+                               (after, RECHECK_BATCH)).fetchall()
+            if not batch:
+                break
+            with db:
+                for layout_id, data in batch:
+                    try:
+                        room, by_type = self.engine.parse(self._placement(unpack(self._kinds, data)))
+                    except ValueError as e:
+                        log.warning("Not re-checking saved layout %d: %s", layout_id, e)
+                        skipped += 1
+                        continue
+                    db.execute('UPDATE layouts SET valid = ?, missing = ?, failed = ? WHERE id = ?',
+                               self._verdict(room, by_type) + (layout_id,))
+                    count += 1
+            after = batch[-1][0]
+        with db:
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rules', ?)", (self.engine.version,))
+        if count or skipped:
+            log.info("Re-checked %d saved layouts against changed rules, skipped %d", count, skipped)
+
+    def save(self, placement):
+        # Save a placement as sent to /validate_placement. Returns
+        # (id, created, verdict); `created` is false when the layout, or a
+        # rotation or reflection of it, was already saved.
+        engine = self.engine
+        room, by_type = engine.parse(placement)
+        if any(kind not in engine.objects for kind in by_type):
+            raise ValueError("Only the simulator's furniture can be saved.")
+        if len(room.walls) > MAX_WALLS or sum(map(len, by_type.values())) > MAX_ITEMS:
+            raise ValueError(f"Saved layouts hold at most {MAX_WALLS} walls and {MAX_ITEMS} items.")
+
+        form = canonical(room, by_type)
+        data = pack(self._kinds, form.rows, form.cols, form.walls, form.items)
+        digest = bytes.fromhex(form.digest)[:16]
+        valid, missing, failed = self._verdict(room, by_type)
+
+        db = self._db()
+        with db:
+            cursor = db.execute(
+                'INSERT INTO layouts (digest, layout, transform, valid, missing, failed, saved) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (digest) DO NOTHING',
+                (digest, data, form.transform, valid, missing, failed, time.time()))
+            created = cursor.rowcount == 1
+            if created:
+                layout_id = cursor.lastrowid
+            else:
+                layout_id, = db.execute('SELECT id FROM layouts WHERE digest = ?', (digest,)).fetchone()
+        return layout_id, created, engine.feedback(missing, failed)
+
+    def _placement(self, layout, transform=0):
+        # A placement dict, in the simulator's format, of a packed layout
+        # turned back by the inverse of `transform`
+        rows, cols, walls, items = layout
+        t = INVERSE[transform]
+        walls = [transform_rect(t, rows, cols, wall) for wall in walls]
+        placed = [(kind,) + transform_rect(t, rows, cols, rect) for kind, *rect in items]
+        if transform in (1, 3, 6, 7):
+            rows, cols = cols, rows
+
+        placement = {}
+        room = self.engine.room
+        if (rows, cols) != (room.rows, room.cols) or sorted(walls) != sorted(room.walls):
+            placement['room'] = {'rows': rows, 'cols': cols,
+                                 'walls': [{'row': r, 'col': c, 'height': h, 'width': w}
+                                           for r, c, h, w in walls]}
+        for kind, row, col, height, width in placed:
+            item = {'row': row, 'col': col, 'width': width, 'height': height, 'type': kind}
+            same = placement.get(kind)
+            if same is None:
+                placement[kind] = item
+            elif isinstance(same, list):
+                same.append(item)
+            else:
+                placement[kind] = [same, item]
+        return placement
+
+    def _entry(self, row):
+        layout_id, data, transform, valid, missing, failed, saved = row
+        return {
+            'id': layout_id,
+            'placement': self._placement(self._unpack(data), transform),
+            'saved': saved,
+            **self.engine.feedback(missing, failed),
+        }
+
+    def get(self, layout_id):
+        row = self._db().execute(
+            'SELECT id, layout, transform, valid, missing, failed, saved FROM layouts WHERE id = ?',
+            (layout_id,)).fetchone()
+        return row and self._entry(row)
+
+    def page(self, before=None, valid=None, limit=PAGE_SIZE):
+        # Up to `limit` layouts saved before the layout `before` (the
+        # previous page's cursor), newest first, optionally only passing or
+        # failing ones. Returns (entries, cursor for the next page or None).
+        where, args = [], []
+        if valid is not None:
+            where.append('valid = ?')
+            args.append(int(valid))
+        if before is not None:
+            where.append('id < ?')
+            args.append(before)
+        sql = ('SELECT id, layout, transform, valid, missing, failed, saved FROM layouts' +
+               (' WHERE ' + ' AND '.join(where) if where else '') +
+               ' ORDER BY id DESC LIMIT ?')
+        rows = self._db().execute(sql, args + [limit + 1]).fetchall()
+        cursor = rows[limit - 1][0] if len(rows) > limit else None
+        return [self._entry(row) for row in rows[:limit]], cursor
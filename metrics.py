@@ -0,0 +1,286 @@
+# Request instrumentation, exposed in Prometheus text format at /metrics.
+#
+# Every request's latency goes into a histogram per route and method, with
+# a counter per status. Time spent rendering templates (per template),
+# serializing jsonify responses and evaluating the rules in
+# /validate_placement is recorded separately, so a slow route can be split
+# into its parts. Rule failures are counted per failure mask as they happen
+# and expanded into per-rule counts only when /metrics is scraped.
+#
+# Recording a measurement is a perf_counter pair, a bisect over the bucket
+# bounds and a short locked increment: a few microseconds per request all
+# told, cheap enough to leave on. Streamed responses are timed until the
+# view returns, not until the stream ends.
+#
+# Set METRICS_PROFILE_RATE in the app config (FLASK_METRICS_PROFILE_RATE in
+# the environment) to profile that fraction of requests with cProfile. Each
+# sampled request's stats are written to METRICS_PROFILE_DIR (by default
+# instance/profiles) for `python -m pstats`, keeping the newest
+# MAX_PROFILES.
+#
+# Metrics are per process: behind serve.py each worker counts only the
+# requests it served.
+
+import cProfile
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+from flask import has_request_context, request, before_render_template, template_rendered
+from flask.json.provider import DefaultJSONProvider
+
+# Upper bounds, in seconds, of the latency buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Profiles kept on disk
+MAX_PROFILES = 100
+
+# Keys of the per-request state in the WSGI environ
+_START = 'metrics.start'
+_RENDER_START = 'metrics.render_start'
+_PROFILE = 'metrics.profile'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+HELP = {
+    'http_request_duration_seconds': "Time from the start of a request to its response, by route and method.",
+    'http_requests_total': "Requests answered, by route, method and status.",
+    'template_render_seconds': "Time spent rendering templates, by template.",
+    'json_response_seconds': "Time spent serializing jsonify responses, by route.",
+    'rule_evaluation_seconds': "Time spent evaluating placement rules in /validate_placement, by source "
+                               "(the verdict table or the live rules).",
+    'rule_checks_total': "Layouts checked against every rule in /validate_placement.",
+    'rule_failures_total': "Layouts that broke each rule in /validate_placement.",
+    'missing_items_total': "Layouts sent to /validate_placement without a required item.",
+    'profiles_total': "Requests profiled.",
+}
+
+
+def _labels(labels):
+    # {name="value",...} of (name, value) pairs
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}' if labels else ''
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    # Not locked itself: Metrics updates and copies it under its own lock
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # Observations per bucket; the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def copy(self):
+        histogram = Histogram(self.buckets)
+        histogram.counts, histogram.sum = list(self.counts), self.sum
+        return histogram
+
+    def lines(self, name, labels):
+        inner = _labels(labels)[1:-1]
+        prefix = inner + ',' if inner else ''
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics, self.name, self.labels = metrics, name, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, self.labels, time.perf_counter() - self.start)
+
+
+class _TimedJSONProvider(DefaultJSONProvider):
+    # jsonify, timed per route
+    metrics = None
+
+    def response(self, *args, **kwargs):
+        # Outside a request (jsonify with only an app context) there's no
+        # route to time it under
+        if not has_request_context():
+            return super().response(*args, **kwargs)
+        start = time.perf_counter()
+        response = super().response(*args, **kwargs)
+        self.metrics.observe('json_response_seconds', (('route', _route(request._get_current_object())),),
+                             time.perf_counter() - start)
+        return response
+
+
+def _route(req):
+    # The URL rule, so made-up URLs don't each get their own series
+    rule = req.url_rule
+    return rule.rule if rule is not None else 'unmatched'
+
+
+class Metrics:
+    def __init__(self, app, engine):
+        self.app = app
+        self.engine = engine
+        # {(name, ((label, value), ...)): Histogram or count}
+        self._histograms = {}
+        self._counters = {}
+        # {failure mask: layouts}, expanded per rule when scraped
+        self._failed_masks = {}
+        self._lock = threading.Lock()
+        # (name, kind, help, read) for numbers read when scraped
+        self._reports = []
+        self._profiles = deque()
+
+        app.config.setdefault('METRICS_PROFILE_RATE', 0.0)
+        app.config.setdefault('METRICS_PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+        app.before_request(self._before)
+        app.after_request(self._after)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        provider = type('TimedJSONProvider', (_TimedJSONProvider,), {'metrics': self})
+        app.json_provider_class = provider
+        app.json = provider(app)
+
+    def observe(self, name, labels, seconds):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, labels=(), n=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+
+    def timer(self, name, **labels):
+        # `with metrics.timer(name, label=value):` observes the block's time
+        return _Timer(self, name, tuple(labels.items()))
+
+    def record_verdict(self, missing, failed):
+        # Count a /validate_placement verdict; rules are only checked when
+        # no required item is missing
+        if missing:
+            self.count('missing_items_total')
+            return
+        with self._lock:
+            self._failed_masks[failed] = self._failed_masks.get(failed, 0) + 1
+
+    def report(self, name, kind, help, read):
+        # Report read() when scraped, as a Prometheus `kind` ("counter" or
+        # "gauge"): a number, or {labels tuple: number}. For numbers other
+        # parts of the app keep anyway.
+        self._reports.append((name, kind, help, read))
+
+    # Per-request state lives in the WSGI environ: one context lookup for
+    # the request, then plain dict access
+    def _before(self):
+        environ = request._get_current_object().environ
+        environ[_START] = time.perf_counter()
+        rate = self.app.config['METRICS_PROFILE_RATE']
+        if rate and random.random() < rate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is already running in this process
+                return
+            environ[_PROFILE] = profile
+
+    def _after(self, response):
+        req = request._get_current_object()
+        start = req.environ.pop(_START, None)
+        if start is None:
+            return response
+        elapsed = time.perf_counter() - start
+        labels = (('route', _route(req)), ('method', req.method))
+        key = ('http_request_duration_seconds', labels)
+        status = ('http_requests_total', labels + (('status', response.status_code),))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(elapsed)
+            self._counters[status] = self._counters.get(status, 0) + 1
+
+        profile = req.environ.pop(_PROFILE, None)
+        if profile is not None:
+            profile.disable()
+            self._save_profile(profile, req.endpoint or 'unmatched')
+        return response
+
+    def _save_profile(self, profile, endpoint):
+        folder = self.app.config['METRICS_PROFILE_DIR']
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, f"{time.time():.6f}-{os.getpid()}-{endpoint}.prof")
+        profile.dump_stats(path)
+        self.count('profiles_total', (('endpoint', endpoint),))
+        with self._lock:
+            self._profiles.append(path)
+            old = self._profiles.popleft() if len(self._profiles) > MAX_PROFILES else None
+        if old is not None:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def _before_render(self, sender, template, context, **extra):
+        request.environ[_RENDER_START] = time.perf_counter()
+
+    def _rendered(self, sender, template, context, **extra):
+        start = request.environ.pop(_RENDER_START, None)
+        if start is not None:
+            self.observe('template_render_seconds', (('template', template.name),), time.perf_counter() - start)
+
+    def render(self):
+        # Everything, in Prometheus text format. Only copying happens under
+        # the lock, so scrapes don't hold up requests.
+        with self._lock:
+            histograms = [(key, histogram.copy()) for key, histogram in self._histograms.items()]
+            counters = dict(self._counters)
+            failed_masks = dict(self._failed_masks)
+
+        checked = sum(failed_masks.values())
+        counters['rule_checks_total', ()] = checked
+        for i, rule in enumerate(self.engine.rules):
+            counters['rule_failures_total', (('rule', rule.id),)] = sum(
+                count for mask, count in failed_masks.items() if mask & (1 << i))
+        counters.setdefault(('missing_items_total', ()), 0)
+
+        lines, seen = [], set()
+        for (name, labels), histogram in sorted(histograms, key=lambda item: item[0]):
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {HELP[name]}", f"# TYPE {name} histogram"]
+            lines += histogram.lines(name, labels)
+        for (name, labels), value in sorted(counters.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            if name not in seen:
+                seen.add(name)
+                lines += [f"# HELP {name} {HELP[name]}", f"# TYPE {name} counter"]
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for name, kind, help, read in self._reports:
+            values = read()
+            if not isinstance(values, dict):
+                values = {(): values}
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            for labels, value in values.items():
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,100 @@
+# Rendered-page cache for the template routes.
+#
+# Pages that only depend on module-level content are rendered once per
+# route and arguments and kept as body bytes with a strong ETag, so
+# repeat visits skip Jinja entirely and a matching If-None-Match gets a
+# 304. The whole cache is dropped when a template file changes or the
+# content the pages are built from does. It is a bounded LRU, and views
+# can refuse to cache arguments they don't know.
+
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, request
+
+# Rendered pages kept
+PAGE_CACHE_SIZE = 256
+
+# Seconds between checks for changed templates or content (every request
+# when the app runs in debug mode)
+CHECK_INTERVAL = 1.0
+
+
+class PageCache:
+    def __init__(self, app, content, max_pages=PAGE_CACHE_SIZE):
+        # `content` returns everything the cached pages are rendered from
+        self.app = app
+        self.content = content
+        self.max_pages = max_pages
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._checked = None
+        self.hits = self.misses = 0
+
+    def _template_stamp(self):
+        stamp = []
+        for folder in self.app.jinja_loader.searchpath:
+            for root, _, files in os.walk(folder):
+                for name in files:
+                    path = os.path.join(root, name)
+                    stamp.append((path, os.stat(path).st_mtime_ns))
+        return tuple(sorted(stamp))
+
+    def _check(self):
+        # Drop every page if the templates or the content have changed
+        now = time.monotonic()
+        interval = 0 if self.app.debug else CHECK_INTERVAL
+        if self._checked is not None and now - self._checked < interval:
+            return
+        content = json.dumps(self.content(), sort_keys=True, default=str).encode()
+        stamp = (self._template_stamp(), hashlib.sha256(content).hexdigest())
+        with self._lock:
+            self._checked = now
+            if stamp != self._stamp:
+                self._stamp = stamp
+                self._pages.clear()
+
+    def cached(self, when=None):
+        # Decorator for a view, under its @app.route. `when(**view_args)`
+        # can turn caching off for arguments the view doesn't know, so
+        # made-up URLs still render but never take up cache space.
+        def decorate(view):
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                if when is not None and not when(**kwargs):
+                    return view(**kwargs)
+                self._check()
+                key = (request.endpoint, tuple(sorted(kwargs.items())))
+                with self._lock:
+                    page = self._pages.get(key)
+                    if page is not None:
+                        self._pages.move_to_end(key)
+                        self.hits += 1
+
+                if page is None:
+                    response = current_app.make_response(view(**kwargs))
+                    # Errors and streamed responses are passed through as they are
+                    if response.status_code != 200 or response.is_streamed:
+                        return response
+                    body = response.get_data()
+                    page = (body, response.mimetype, hashlib.sha256(body).hexdigest())
+                    with self._lock:
+                        self.misses += 1
+                        self._pages[key] = page
+                        while len(self._pages) > self.max_pages:
+                            self._pages.popitem(last=False)
+
+                body, mimetype, etag = page
+                response = Response(body, mimetype=mimetype)
+                response.set_etag(etag)
+                # Let browsers keep the page but ask before reusing it
+                response.cache_control.no_cache = True
+                return response.make_conditional(request)
+            return wrapper
+        return decorate
@@ -0,0 +1,31 @@
+# Room placement rules used by the /validate_placement endpoints.
+# The rules themselves are declared in data/room_rules.json and compiled by
+# rule_engine.RuleEngine when this module is imported.
+
+from rule_engine import RuleEngine
+
+engine = RuleEngine.from_file()
+
+GRID_ROWS, GRID_COLS = engine.room.rows, engine.room.cols
+
+# Required unique items
+REQUIRED = engine.required
+
+# Failure messages in the order the rules are checked.
+# Bit i of a failure mask is set when rule i is broken.
+RULE_MESSAGES = engine.messages
+
+SUCCESS_MESSAGE = engine.success
+
+# Fingerprint of everything that decides a failure mask, so precomputed
+# verdicts can tell when the rules they were built from have changed
+RULE_VERSION = engine.version
+
+
+def feedback_for(missing, failed):
+    return engine.feedback(missing, failed)
+
+
+def validate(placement):
+    # Raises ValueError for placements that can't be read as a room
+    return engine.validate(placement)
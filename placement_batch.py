@@ -0,0 +1,281 @@
+# Vectorized validation of many room layouts at once.
+#
+# Layouts holding only the required items in the default room are packed
+# into (n, items) arrays of rows, columns and footprints, and every rule is
+# evaluated with NumPy over those arrays. Anything else goes through the
+# rule engine one layout at a time, so each result is identical to
+# /validate_placement.
+
+import json
+from collections import namedtuple
+
+import numpy as np
+
+from placement import engine, feedback_for, validate
+
+REQUIRED = engine.required
+_INDEX = {kind: j for j, kind in enumerate(REQUIRED)}
+_DEFAULTS = [engine.footprint(kind) for kind in REQUIRED]
+
+# Arrays of shape (n, len(REQUIRED)), one row per layout
+Rects = namedtuple('Rects', 'row col height width')
+
+
+def _overlaps(a0, alen, b0, blen):
+    # Do the spans [a0, a0+alen) and [b0, b0+blen) share a cell?
+    return (a0 < b0 + blen) & (b0 < a0 + alen)
+
+
+def _overlapping(r, room):
+    # Layouts where two items, or an item and a wall, share a cell
+    k = len(REQUIRED)
+    def hits(j, row, col, height, width):
+        return (_overlaps(r.row[:, j], r.height[:, j], row, height) &
+                _overlaps(r.col[:, j], r.width[:, j], col, width))
+    out = np.zeros(len(r.row), dtype=bool)
+    for j in range(k):
+        for i in range(j + 1, k):
+            out |= hits(j, r.row[:, i], r.col[:, i], r.height[:, i], r.width[:, i])
+        for wall in room.walls:
+            out |= hits(j, *wall)
+    return out
+
+
+def _covered(lo, hi, spans):
+    # Does the union of `spans` ((lo, hi) pairs, empty when lo > hi) cover
+    # every cell of [lo, hi]? Two spans at most.
+    (alo, ahi), (blo, bhi) = spans
+    return (((alo <= lo) & (hi <= ahi)) | ((blo <= lo) & (hi <= bhi)) |
+            ((alo <= lo) & (blo <= ahi + 1) & (hi <= bhi) & (blo <= bhi)) |
+            ((blo <= lo) & (alo <= bhi + 1) & (hi <= ahi) & (alo <= ahi)))
+
+
+def _sight_blocked(r, a, b, room):
+    # visibility.Sightlines.clear for item columns a and b of every layout.
+    # Each blocker (another item or a wall) is tested a row at a time
+    # against the run of cells the ray crosses in that row. As there, the
+    # cells of a and b themselves never block, even where a blocker
+    # overlaps them.
+    y0, x0 = 2*r.row[:, a] + r.height[:, a], 2*r.col[:, a] + r.width[:, a]
+    y1, x1 = 2*r.row[:, b] + r.height[:, b], 2*r.col[:, b] + r.width[:, b]
+    swap = y0 > y1
+    y0, y1 = np.where(swap, y1, y0), np.where(swap, y0, y1)
+    x0, x1 = np.where(swap, x1, x0), np.where(swap, x0, x1)
+    dy, dx = y1 - y0, x1 - x0
+
+    # Rays along a single row (dy == 0) only cross that row, if any
+    flat = dy == 0
+    flat_row = np.where(flat & (y0 % 2 == 1) & (dx != 0), (y0 - 1) // 2, -1)
+    flat_lo, flat_hi = np.minimum(x0, x1) // 2, (np.maximum(x0, x1) - 1) // 2
+    div = 2 * np.where(flat, 1, dy)
+    first, last = np.where(flat, -1, y0 // 2), np.where(flat, -2, (y1 - 1) // 2)
+
+    blockers = [(r.row[:, j], r.col[:, j], r.height[:, j], r.width[:, j])
+                for j in range(len(REQUIRED)) if j not in (a, b)]
+    blockers += room.walls
+
+    # a's and b's own columns, in the rows they span
+    owners = [(r.row[:, j], r.height[:, j], r.col[:, j], r.col[:, j] + r.width[:, j] - 1) for j in (a, b)]
+
+    blocked = np.zeros(len(y0), dtype=bool)
+    for row, col, height, width in blockers:
+        for i in range(int(np.max(height))):
+            line = row + i
+            na = x0*dy + (np.maximum(y0, 2*line) - y0) * dx
+            nb = x0*dy + (np.minimum(y1, 2*line + 2) - y0) * dx
+            lo = np.where(flat, flat_lo, np.minimum(na, nb) // div)
+            hi = np.where(flat, flat_hi, (np.maximum(na, nb) - 1) // div)
+            crossed = (line == flat_row) | ((first <= line) & (line <= last))
+            # The blocker's cells the ray crosses in this line
+            lo, hi = np.maximum(lo, col), np.minimum(hi, col + width - 1)
+            own = []
+            for orow, oheight, olo, ohi in owners:
+                inside = (orow <= line) & (line < orow + oheight)
+                own.append((np.where(inside, olo, 1), np.where(inside, ohi, 0)))
+            blocked |= crossed & (i < height) & (lo <= hi) & ~_covered(lo, hi, own)
+    return blocked
+
+
+# Vectorized versions of the rule_engine checks. Each factory takes the rule
+# spec and the room, and returns a function from Rects to a "broken" array.
+
+def _on_perimeter(spec, room):
+    j = _INDEX[spec['items'][0]]
+    def broken(r):
+        row, col = r.row[:, j], r.col[:, j]
+        return ~((row == 0) | (col == 0) |
+                 (row + r.height[:, j] == room.rows) | (col + r.width[:, j] == room.cols))
+    return broken
+
+def _lined_up(spec, room):
+    a, b = (_INDEX[kind] for kind in spec['items'])
+    def broken(r):
+        lined_up = (_overlaps(r.row[:, a], r.height[:, a], r.row[:, b], r.height[:, b]) |
+                    _overlaps(r.col[:, a], r.width[:, a], r.col[:, b], r.width[:, b]))
+        return lined_up & ~_sight_blocked(r, a, b, room)
+    return broken
+
+def _clear_view(spec, room):
+    a, b = (_INDEX[kind] for kind in spec['items'])
+    d = spec['distance']
+    def broken(r):
+        near = (_overlaps(r.row[:, a] - d, r.height[:, a] + 2*d, r.row[:, b], r.height[:, b]) &
+                _overlaps(r.col[:, a] - d, r.width[:, a] + 2*d, r.col[:, b], r.width[:, b]))
+        return ~(near & ~_sight_blocked(r, a, b, room))
+    return broken
+
+def _no_overlap(spec, room):
+    def broken(r):
+        return _overlapping(r, room)
+    return broken
+
+VECTOR_CHECKS = {
+    'on_perimeter': _on_perimeter,
+    'not_aligned': _lined_up,
+    'not_facing': _lined_up,
+    'clear_view': _clear_view,
+    'no_overlap': _no_overlap,
+}
+
+
+def checks_for(room):
+    # (bit, broken) for every rule that can apply to a layout of required
+    # items in `room`; rules about other item types never do
+    checks = []
+    for i, spec in enumerate(engine.definition['rules']):
+        if all(kind in _INDEX for kind in spec['items']):
+            checks.append((i, VECTOR_CHECKS[spec['check']](spec, room)))
+    return checks
+
+_CHECKS = checks_for(engine.room)
+_RULE_BITS = len(engine.rules)
+
+
+def failure_masks(rects, checks=_CHECKS):
+    # Failed-rule mask of every layout, as in RuleEngine.failed. `checks`
+    # come from checks_for the layouts' room.
+    mask = np.zeros(len(rects.row), dtype=np.int64)
+    for bit, broken in checks:
+        mask |= broken(rects).astype(np.int64) << bit
+    return mask
+
+
+def vectorizable(rects, room=engine.room):
+    # Layouts whose verdict failure_masks computes exactly: every item
+    # inside the room. Shape (n,).
+    return in_room(rects, room).all(axis=1)
+
+
+def in_room(rects, room=engine.room):
+    # Which items lie inside the room, shape (n, len(REQUIRED))
+    return ((rects.row >= 0) & (rects.col >= 0) & (rects.height > 0) & (rects.width > 0) &
+            (rects.row + rects.height <= room.rows) &
+            (rects.col + rects.width <= room.cols))
+
+
+# One shared response per (missing mask, failed mask) pair
+_responses = {}
+
+def _response(code):
+    if code not in _responses:
+        _responses[code] = feedback_for(code >> _RULE_BITS, code & ((1 << _RULE_BITS) - 1))
+    return _responses[code]
+
+
+def _extract(layouts):
+    # Pack layouts into Rects for the vectorized path. Layouts the arrays
+    # can't represent are listed in `slow` by index.
+    k = len(REQUIRED)
+    known = _INDEX.keys()
+    defaults = [(req, 1 << j, h, w) for j, (req, (h, w)) in enumerate(zip(REQUIRED, _DEFAULTS))]
+    values = []
+    missing = []
+    slow = []
+
+    for i, layout in enumerate(layouts):
+        absent = 0
+        if isinstance(layout, dict) and layout.keys() <= known:
+            for req, bit, h, w in defaults:
+                item = layout.get(req)
+                if item is None:
+                    if req in layout:
+                        break
+                    absent |= bit
+                    values += (0, 0, h, w)
+                    continue
+                try:
+                    r, c = item['row'], item['col']
+                    h, w = item.get('height', h), item.get('width', w)
+                except (TypeError, KeyError, AttributeError):
+                    break
+                if not (type(r) is int and type(c) is int and type(h) is int and type(w) is int):
+                    break
+                values += (r, c, h, w)
+            else:
+                missing.append(absent)
+                continue
+        # Not representable: pad the arrays and let the rule engine decide
+        slow.append(i)
+        missing.append(0)
+        del values[4*k*i:]
+        values += (0, 0, 1, 1) * k
+
+    packed = np.array(values, dtype=np.int64).reshape(len(layouts), k, 4)
+    rects = Rects(*(packed[:, :, f] for f in range(4)))
+    return rects, np.array(missing, dtype=np.int64), slow
+
+
+def validate_batch(layouts):
+    # Validate a list of placement dicts; returns one response dict per layout
+    rects, missing, slow = _extract(layouts)
+
+    # Off-grid items are reported by the rule engine
+    placed = (missing[:, None] >> np.arange(len(REQUIRED))) & 1 == 0
+    outside = (~in_room(rects) & placed).any(axis=1)
+    slow = sorted(set(slow) | set(np.nonzero(outside)[0].tolist()))
+
+    codes = failure_masks(rects)
+    codes[missing != 0] = 0
+    codes |= missing << _RULE_BITS
+
+    results = [_response(code) for code in codes.tolist()]
+    for i in slow:
+        try:
+            results[i] = validate(layouts[i])
+        except ValueError as e:
+            results[i] = {'error': str(e)}
+    return results
+
+
+def parse_ndjson(text):
+    # One layout per non-blank line. Parsed as one JSON array; a line that
+    # isn't a whole JSON value on its own can only run into its neighbours
+    # (the array's own brackets can't close early), leaving fewer values
+    # than lines, so that's caught by parsing line by line instead.
+    lines = [line for line in text.splitlines() if line.strip()]
+    layouts = json.loads('[' + ','.join(lines) + ']')
+    if len(layouts) != len(lines):
+        layouts = [json.loads(line) for line in lines]
+    return layouts
+
+
+def _encoded(results, dumps):
+    # JSON of each result. Most results are shared responses (see
+    # _response), encoded once each.
+    seen = {}
+    out = []
+    for result in results:
+        text = seen.get(id(result))
+        if text is None:
+            text = seen[id(result)] = dumps(result)
+        out.append(text)
+    return out
+
+
+def dump_ndjson(results, dumps=json.dumps):
+    return ''.join(text + '\n' for text in _encoded(results, dumps))
+
+
+def dump_json(results, dumps=json.dumps):
+    # The results as one JSON array, on a line of its own like jsonify's
+    return '[' + ','.join(_encoded(results, dumps)) + ']\n'
@@ -0,0 +1,239 @@
+# "Fix this room" challenges for the simulator.
+#
+# A challenge is a room with some walls and a few locked items already in
+# place; the student places the rest of the required items. The generator
+# draws random starting configurations and counts every way of placing the
+# remaining items that passes the /validate_placement rules, by enumerating
+# them all with placement_batch. Configurations with no solution are
+# dropped, and the rest are rated by how many solutions they have: the
+# fewer, the harder.
+#
+# A background thread keeps a pool of ready challenges for each tier, so
+# handing one out never waits on a search. Forked workers (see serve.py)
+# start their own thread, with a copy of the pool as it was.
+
+import os
+import random
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import placement_batch
+
+# (tier, locked items, fewest solutions, seconds allowed), easiest first.
+# A challenge lands in the first tier it has enough solutions for; the
+# locked count is what the generator tries when that tier runs low, since
+# every locked item leaves one fewer to place.
+TIERS = (
+    ('easy', 1, 1000, 120),
+    ('medium', 2, 50, 90),
+    ('hard', 3, 1, 60),
+)
+
+# Ready challenges kept per tier
+POOL_SIZE = 8
+
+# Walls are straight runs of 2-3 cells; rooms get up to MAX_WALLS of them
+MAX_WALLS = 3
+
+# Layouts checked per placement_batch call while counting solutions
+CHUNK = 65536
+
+
+def _spots(room, height, width, occupied):
+    # Every (row, col) where a height x width item fits without covering
+    # `occupied`
+    return [(row, col)
+            for row in range(room.rows - height + 1)
+            for col in range(room.cols - width + 1)
+            if not room.rect(row, col, height, width) & occupied]
+
+
+def count_solutions(engine, room, locked):
+    # How many placements of the required items missing from `locked`
+    # ({type: (row, col)}, at default footprints) pass every rule
+    required = placement_batch.REQUIRED
+    free = [kind for kind in required if kind not in locked]
+    occupied = room.wall_mask
+    for kind, (row, col) in locked.items():
+        occupied |= room.rect(row, col, *engine.footprint(kind))
+    spots = [np.array(_spots(room, *engine.footprint(kind), occupied), dtype=np.int64).reshape(-1, 2)
+             for kind in free]
+    if any(len(s) == 0 for s in spots):
+        return 0
+
+    checks = placement_batch.checks_for(room)
+    footprints = np.array([engine.footprint(kind) for kind in required], dtype=np.int64)
+    total = int(np.prod([len(s) for s in spots]))
+    solutions = 0
+    for start in range(0, total, CHUNK):
+        # Layout i places free item j at spots[j][digit j of i]
+        index = np.arange(start, min(start + CHUNK, total))
+        rows = np.empty((len(index), len(required)), dtype=np.int64)
+        cols = np.empty_like(rows)
+        for j, kind in enumerate(required):
+            if kind in locked:
+                rows[:, j], cols[:, j] = locked[kind]
+        for kind, s in zip(reversed(free), reversed(spots)):
+            j = required.index(kind)
+            pick = s[index % len(s)]
+            rows[:, j], cols[:, j] = pick[:, 0], pick[:, 1]
+            index //= len(s)
+
+        rects = placement_batch.Rects(rows, cols,
+                                      np.broadcast_to(footprints[:, 0], rows.shape),
+                                      np.broadcast_to(footprints[:, 1], rows.shape))
+        ok = placement_batch.vectorizable(rects, room) & (placement_batch.failure_masks(rects, checks) == 0)
+        solutions += int(np.count_nonzero(ok))
+    return solutions
+
+
+def tier_for(solutions):
+    for name, _, fewest, _ in TIERS:
+        if solutions >= fewest:
+            return name
+    return None
+
+
+class Generator:
+    def __init__(self, engine, seed=None):
+        self.engine = engine
+        self.random = random.Random(seed)
+
+    def _walls(self):
+        rows, cols = self.engine.room.rows, self.engine.room.cols
+        walls = []
+        for _ in range(self.random.randint(0, MAX_WALLS)):
+            length = self.random.randint(2, 3)
+            height, width = (length, 1) if self.random.random() < 0.5 else (1, length)
+            walls.append({'row': self.random.randint(0, rows - height),
+                          'col': self.random.randint(0, cols - width),
+                          'height': height, 'width': width})
+        return walls
+
+    def generate(self, count):
+        # A random challenge with `count` locked items as a dict, or None
+        # when it has no solution
+        engine = self.engine
+        walls = self._walls()
+        room = engine.room_for({'rows': engine.room.rows, 'cols': engine.room.cols, 'walls': walls})
+
+        locked = {}
+        occupied = room.wall_mask
+        for kind in self.random.sample(placement_batch.REQUIRED, count):
+            height, width = engine.footprint(kind)
+            spots = _spots(room, height, width, occupied)
+            if not spots:
+                return None
+            row, col = locked[kind] = self.random.choice(spots)
+            occupied |= room.rect(row, col, height, width)
+
+        solutions = count_solutions(engine, room, locked)
+        if not solutions:
+            return None
+        name = tier_for(solutions)
+        return {
+            'tier': name,
+            'room': {'rows': room.rows, 'cols': room.cols, 'walls': walls},
+            'locked': {kind: {'row': row, 'col': col} for kind, (row, col) in locked.items()},
+            'place': [kind for kind in placement_batch.REQUIRED if kind not in locked],
+            'solutions': solutions,
+            'time_limit': next(limit for tier, _, _, limit in TIERS if tier == name),
+        }
+
+
+class ChallengePool:
+    def __init__(self, engine, size=POOL_SIZE, seed=None):
+        self.generator = Generator(engine, seed)
+        self.size = size
+        self._ready = {name: deque() for name, _, _, _ in TIERS}
+        self._cond = threading.Condition()
+        self._thread = None
+
+        # Generation stats
+        self.generated = self.unsolvable = self.discarded = 0
+        self.busy = 0.0
+        # When challenges not yet replaced were taken from each tier, and
+        # how long refills took
+        self._taken = {name: deque() for name, _, _, _ in TIERS}
+        self.refills = 0
+        self.refill_total = self.refill_max = 0.0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        # Only the forking thread survives, and the condition may have been
+        # held by another. Workers mustn't all draw the same rooms.
+        self._cond = threading.Condition()
+        self.generator.random.seed()
+        if self._thread is not None:
+            self._thread = None
+            self.start()
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='challenge-pool', daemon=True)
+                self._thread.start()
+
+    def _lowest(self):
+        # Locked-item count for the tier with the fewest ready challenges,
+        # or None when every tier is full
+        name, count, _, _ = min(TIERS, key=lambda tier: len(self._ready[tier[0]]))
+        return count if len(self._ready[name]) < self.size else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._lowest() is None:
+                    self._cond.wait()
+                count = self._lowest()
+
+            started = time.monotonic()
+            challenge = self.generator.generate(count)
+            now = time.monotonic()
+
+            with self._cond:
+                self.generated += 1
+                self.busy += now - started
+                if challenge is None:
+                    self.unsolvable += 1
+                    continue
+                ready = self._ready[challenge['tier']]
+                if len(ready) >= self.size:
+                    self.discarded += 1
+                    continue
+                ready.append(challenge)
+                taken = self._taken[challenge['tier']]
+                if taken:
+                    latency = now - taken.popleft()
+                    self.refills += 1
+                    self.refill_total += latency
+                    self.refill_max = max(self.refill_max, latency)
+
+    def take(self, tier):
+        # A ready challenge from the tier, or None if the pool is empty.
+        # Raises KeyError for unknown tiers.
+        with self._cond:
+            ready = self._ready[tier]
+            if not ready:
+                return None
+            self._taken[tier].append(time.monotonic())
+            self._cond.notify()
+            return ready.popleft()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'ready': {name: len(ready) for name, ready in self._ready.items()},
+                'pool_size': self.size,
+                'generated': self.generated,
+                'unsolvable': self.unsolvable,
+                'discarded': self.discarded,
+                'per_second': self.generated / self.busy if self.busy else 0.0,
+                'mean_generation_ms': 1000 * self.busy / self.generated if self.generated else 0.0,
+                'refills': self.refills,
+                'mean_refill_ms': 1000 * self.refill_total / self.refills if self.refills else 0.0,
+                'max_refill_ms': 1000 * self.refill_max,
+            }
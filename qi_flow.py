@@ -0,0 +1,133 @@
+# Qì flow through a room, as a heatmap over the grid.
+#
+# Qì enters at the door and spreads to neighbouring free cells, losing a
+# little strength with every step. Walls and furniture stop it. Mirrors
+# stop it too, but send part of what reaches them back into the room.
+# Both passes are breadth-first floods done as whole-grid NumPy steps.
+#
+# Fields are cached by canonical layout (see canonical.py), so a layout and
+# its rotations and reflections are only ever computed once.
+
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from canonical import INVERSE, canonical, transform_grid
+
+# Share of qì kept per step, and share a mirror sends back
+DECAY = 0.9
+REFLECT = 0.5
+
+# Qì weaker than this has faded out, so floods stop after HORIZON steps
+# whatever the size of the room
+FADE = 1e-3
+HORIZON = math.ceil(math.log(FADE) / math.log(DECAY))
+
+# Cached fields
+CACHE_SIZE = 256
+
+# Furniture that isn't an obstacle like the rest
+SOURCE, REFLECTOR = 'door', 'mirror'
+
+
+def _floods(door, mirror, free):
+    # Breadth-first distances of the direct flood from the door (layer 0)
+    # and of the flood mirrors send back (layer 1), -1 where qì never gets
+    # within HORIZON steps.
+    # Both advance together, one whole-grid step per loop, so every array
+    # operation covers both layers. A mirror joins layer 1 on the step the
+    # direct flood first reaches it.
+    #
+    # The grid is flattened with a border of closed cells (one column to
+    # the right, one row above and below), so the four neighbours of a cell
+    # are plain offsets of 1 and of the padded row width.
+    rows, cols = free.shape
+    width = cols + 1
+
+    def flat(grid):
+        padded = np.zeros((rows + 2, width), dtype=bool)
+        padded[1:-1, :-1] = grid
+        return padded.ravel()
+
+    dist = np.full((2, (rows + 2) * width), -1, dtype=np.int32)
+    open_ = np.stack([flat(free), flat(free)])
+    front = np.zeros_like(open_)
+    grown = np.empty_like(open_)
+    front[0] = flat(door)
+    open_ &= ~front
+    waiting = flat(mirror)
+    waiting_left = waiting.any()
+    step = 0
+    while True:
+        np.copyto(dist, step, where=front)
+        step += 1
+        if step > HORIZON:
+            break
+
+        np.copyto(grown, front)
+        for k in (1, width):
+            grown[:, k:] |= front[:, :-k]
+            grown[:, :-k] |= front[:, k:]
+        np.logical_and(grown, open_, out=front)
+
+        if waiting_left:
+            hit = grown[0] & waiting
+            if hit.any():
+                front[1] |= hit
+                open_[1] |= hit
+                waiting ^= hit
+                waiting_left = waiting.any()
+        if not front.any():
+            break
+        # front only holds open cells, so this closes exactly those
+        open_ ^= front
+
+    dist = dist.reshape(2, rows + 2, width)[:, 1:-1, :-1]
+    return dist[0], dist[1]
+
+
+def _compute(rows, cols, walls, items):
+    blocked = np.zeros((rows, cols), dtype=bool)
+    door = np.zeros_like(blocked)
+    mirror = np.zeros_like(blocked)
+    for r, c, h, w in walls:
+        blocked[r:r+h, c:c+w] = True
+    for kind, r, c, h, w in items:
+        {SOURCE: door, REFLECTOR: mirror}.get(kind, blocked)[r:r+h, c:c+w] = True
+    free = ~(blocked | door | mirror)
+
+    primary, reflected = _floods(door, mirror, free)
+
+    field = np.where(primary >= 0, DECAY ** primary.astype(np.float32), 0)
+    field += np.where((reflected >= 0) & free, REFLECT * DECAY ** reflected.astype(np.float32), 0)
+    field = np.minimum(field, 1).astype(np.float32)
+    field[mirror] = 0
+    field.flags.writeable = False
+    return field
+
+
+class QiFlow:
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def field(self, room, by_type):
+        # Heatmap for a parsed layout, as a float32 array indexed [row, col]
+        form = canonical(room, by_type)
+        with self._lock:
+            field = self._cache.get(form.digest)
+            if field is not None:
+                self._cache.move_to_end(form.digest)
+                self.hits += 1
+        if field is None:
+            field = _compute(form.rows, form.cols, form.walls, form.items)
+            with self._lock:
+                self.misses += 1
+                self._cache[form.digest] = field
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return transform_grid(INVERSE[form.transform], field)
@@ -0,0 +1,155 @@
+# Quiz bank: every question in data/quiz/*.json, compiled once at startup.
+#
+# Questions are numbered in file order (files sorted by name). The answer
+# key is one string holding each question's correct letter, next to a
+# string of the letters it accepts, so grading an answer is a dict lookup
+# and a character compare. A quiz is either the default one (every
+# question, in order, as /quiz shows it) or a random subset drawn from a
+# seed: clients send the seed back with their answers, and the question
+# list is drawn again instead of being stored anywhere.
+#
+# grade_stream grades NDJSON submissions a line at a time, so a whole
+# class can be graded in one request without holding it in memory.
+
+import json
+import os
+import random
+from collections import namedtuple
+from functools import lru_cache
+
+QUIZ_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'quiz')
+
+# Seeds are 32-bit, so they fit in a form field and a JS number
+MAX_SEED = 2 ** 32
+
+# Drawn quizzes remembered, by (count, seed)
+DRAW_CACHE_SIZE = 1024
+
+# Bytes read from a request body at a time while grading
+READ_SIZE = 64 * 1024
+
+# `choices` are (letter, text) pairs in the order they're shown
+Question = namedtuple('Question', 'id text choices')
+
+
+class QuizBank:
+    def __init__(self, path=QUIZ_DIR):
+        self.questions = []
+        self.index = {}
+        key, letters = [], []
+        for filename in sorted(os.listdir(path)):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(path, filename), encoding='utf-8') as f:
+                specs = json.load(f)['questions']
+            for spec in specs:
+                qid, choices, answer = spec['id'], spec['choices'], spec['answer']
+                if qid in self.index:
+                    raise ValueError(f"Quiz question {qid} is defined twice.")
+                if not all(len(letter) == 1 for letter in choices) or answer not in choices:
+                    raise ValueError(f"Quiz question {qid} needs one-letter choices, answer among them.")
+                self.index[qid] = len(self.questions)
+                self.questions.append(Question(qid, spec['text'], tuple(choices.items())))
+                key.append(answer)
+                letters.append(''.join(choices))
+        self.key = ''.join(key)
+        self.letters = tuple(letters)
+        self._draw = lru_cache(maxsize=DRAW_CACHE_SIZE)(self._sample)
+
+    def __len__(self):
+        return len(self.questions)
+
+    def _sample(self, count, seed):
+        return tuple(random.Random(seed).sample(range(len(self.questions)), count))
+
+    def quiz(self, count=None, seed=None):
+        # Question numbers of a quiz: the default one without a seed, else
+        # `count` questions (all of them, shuffled, by default) drawn with
+        # the seed. Both may be ints or decimal strings, as from a form.
+        if seed is None:
+            if count is not None:
+                raise ValueError("A quiz with a question count needs a seed.")
+            return tuple(range(len(self.questions)))
+        seed, count = _number(seed, 'seed'), _number(count, 'count', len(self.questions))
+        if not 0 <= seed < MAX_SEED:
+            raise ValueError(f"The seed must be below {MAX_SEED}.")
+        if not 1 <= count <= len(self.questions):
+            raise ValueError(f"A quiz has 1 to {len(self.questions)} questions.")
+        return self._draw(count, seed)
+
+    def public(self, numbers):
+        # The questions without their answers, for the client
+        return [{'id': q.id, 'text': q.text, 'choices': dict(q.choices)}
+                for q in map(self.questions.__getitem__, numbers)]
+
+    def grade(self, numbers, answers):
+        # (score, wrong, unanswered) for answers ({question id: letter}) to
+        # a quiz; wrong holds (number, letter) pairs. Answers to questions
+        # not in the quiz are ignored.
+        score, wrong, unanswered = 0, [], []
+        for i in numbers:
+            choice = answers.get(self.questions[i].id)
+            if choice is None:
+                unanswered.append(i)
+            elif choice == self.key[i]:
+                score += 1
+            elif isinstance(choice, str) and len(choice) == 1 and choice in self.letters[i]:
+                wrong.append((i, choice))
+            else:
+                raise ValueError(f"{choice!r} is not a choice for question {self.questions[i].id}.")
+        return score, wrong, unanswered
+
+    def choice_text(self, i, letter):
+        return dict(self.questions[i].choices)[letter]
+
+    def grade_stream(self, lines):
+        # Grade NDJSON submissions, {"id", "seed", "count", "answers"} with
+        # only "answers" required, yielding one NDJSON result per line:
+        # {"id", "score", "total", "incorrect", "unanswered"} (question ids),
+        # or {"id", "error"}
+        for line in lines:
+            if not line.strip():
+                continue
+            result = {}
+            try:
+                submission = json.loads(line)
+                if not isinstance(submission, dict) or not isinstance(submission.get('answers'), dict):
+                    raise ValueError("A submission needs an answers object.")
+                if 'id' in submission:
+                    result['id'] = submission['id']
+                numbers = self.quiz(submission.get('count'), submission.get('seed'))
+                score, wrong, unanswered = self.grade(numbers, submission['answers'])
+                result.update({
+                    'score': score,
+                    'total': len(numbers),
+                    'incorrect': [self.questions[i].id for i, _ in wrong],
+                    'unanswered': [self.questions[i].id for i in unanswered],
+                })
+            except ValueError as e:
+                result['error'] = str(e)
+            yield json.dumps(result) + '\n'
+
+
+def _number(value, name, default=None):
+    if value is None:
+        return default
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+    if type(value) is not int:
+        raise ValueError(f"The {name} must be a whole number.")
+    return value
+
+
+def read_lines(stream, size=READ_SIZE):
+    # Lines of a binary stream, read in blocks: iterating a request stream
+    # directly reads a line per call, which is far slower
+    rest = b''
+    while True:
+        block = stream.read(size)
+        if not block:
+            break
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
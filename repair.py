@@ -0,0 +1,262 @@
+# Repair hints: the fewest item moves that make a layout pass every rule.
+#
+# The search is A* over whole layouts. A step moves one item that hasn't
+# moved yet to another free cell, or places a required item that is
+# missing, so a layout's cost is the number of items it has moved. The
+# heuristic counts the missing items (plus one for a broken rule no
+# placement can fix), which never overestimates; ties go to the layout with
+# the fewest problems left, so the search heads for a fix quickly.
+#
+# Moves are pruned with the rule predicates before a layout is checked:
+# an item never lands on a wall or another item, nor anywhere that breaks a
+# rule about that item alone (a door off the perimeter). Layouts reached
+# again by moving the same items in another order are skipped. In the
+# default room, all the moves out of a layout are checked at once with
+# placement_batch.
+#
+# Searches stop at a time budget and answer with the best layout found so
+# far. Finished searches are cached by canonical layout (see canonical.py),
+# so a rotated or mirrored room is answered from the cache too.
+
+import heapq
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+import placement_batch
+from canonical import INVERSE, canonical, transform_rect
+from rule_engine import Item
+from visibility import Sightlines
+
+# Seconds a search may take before it answers with its best layout so far
+TIME_BUDGET = 0.2
+
+# Cached repairs
+CACHE_SIZE = 1024
+
+# Checks that placing more furniture can never fix, once every item they
+# are about is in the room: only moving those items can
+SETTLED = {'on_perimeter', 'clear_view', 'no_overlap'}
+
+
+def _rect(item):
+    return (item.row, item.col, item.height, item.width)
+
+
+def _problems(engine, room, slots, state):
+    # (missing items, failed-rule mask) of a state
+    by_type = {}
+    missing = 0
+    for (kind, _), item in zip(slots, state):
+        if item is None:
+            missing += 1
+        else:
+            by_type.setdefault(kind, []).append(item)
+    return missing, engine.failed(room, by_type)
+
+
+class _Search:
+    def __init__(self, engine, room, by_type, deadline):
+        self.engine = engine
+        self.room = room
+        self.deadline = deadline
+
+        # One slot per item: (type, where it started, or None if missing)
+        self.slots = [(kind, item) for kind, items in by_type.items() for item in items]
+        self.slots += [(kind, None) for kind in engine.required if kind not in by_type]
+
+        # Rules that only look at one item type, checked on the moved item alone
+        self.unary = {}
+        self.settled = 0
+        for i, rule in enumerate(engine.rules):
+            if engine.definition['rules'][i]['check'] in SETTLED:
+                self.settled |= 1 << i
+            if rule.watches is not None and len(rule.watches) == 1:
+                kind, = rule.watches
+                self.unary.setdefault(kind, []).append(i)
+
+        # Layouts of just the required items in the default room are checked
+        # a slot's worth of moves at a time with placement_batch
+        self.columns = None
+        if (engine is placement_batch.engine and room is engine.room and
+                sorted(kind for kind, _ in self.slots) == sorted(placement_batch.REQUIRED)):
+            self.columns = [placement_batch.REQUIRED.index(kind) for kind, _ in self.slots]
+
+    def _spots(self, slot, state):
+        # Where the item in `slot` may go: inside the room, off the walls
+        # and the other items, and not breaking a rule about it alone
+        engine, room = self.engine, self.room
+        kind, start = self.slots[slot]
+        height, width = (start.height, start.width) if start else engine.footprint(kind)
+        occupied = room.wall_mask
+        for i, item in enumerate(state):
+            if item is not None and i != slot:
+                occupied |= item.mask
+        unary = self.unary.get(kind, ())
+
+        for row in range(room.rows - height + 1):
+            for col in range(room.cols - width + 1):
+                mask = room.rect(row, col, height, width)
+                if mask & occupied or (start and (row, col) == (start.row, start.col)):
+                    continue
+                item = Item(kind, row, col, height, width, mask)
+                if unary:
+                    alone = {kind: [item]}
+                    sight = Sightlines(room, alone)
+                    if any(engine.rule_broken(i, room, alone, sight) for i in unary):
+                        continue
+                yield item
+
+    def _check(self, children):
+        # (missing items, failed-rule mask) of each child state. Checked one
+        # by one, this stops at the deadline with the children done so far.
+        if self.columns is None or None in children[0]:
+            results = []
+            for child in children:
+                results.append(_problems(self.engine, self.room, self.slots, child))
+                if time.monotonic() > self.deadline:
+                    break
+            return results
+
+        packed = np.zeros((len(children), len(self.columns), 4), dtype=np.int64)
+        for slot, j in enumerate(self.columns):
+            packed[:, j] = [_rect(child[slot]) for child in children]
+        rects = placement_batch.Rects(*(packed[:, :, f] for f in range(4)))
+        failed = placement_batch.failure_masks(rects).tolist()
+        exact = placement_batch.vectorizable(rects).tolist()
+        return [(0, mask) if ok else _problems(self.engine, self.room, self.slots, child)
+                for mask, ok, child in zip(failed, exact, children)]
+
+    def run(self):
+        engine, room = self.engine, self.room
+        start = tuple(item for _, item in self.slots)
+        missing, failed = _problems(engine, room, self.slots, start)
+
+        def priority(moved, missing, failed):
+            # Placing a missing item can block a sightline and fix a rule,
+            # but not a settled one; those take a move of their own
+            h = missing + (1 if failed & (self.settled if missing else -1) else 0)
+            return (moved + h, missing + bin(failed).count('1'))
+
+        # Heap entries: (f, problems, tie, moved, state, moved slots)
+        tie = 0
+        heap = [priority(0, missing, failed) + (tie, 0, start, frozenset())]
+        seen = {start}
+        best = (missing, failed, 0, start)
+
+        while heap:
+            f, problems, _, moved, state, done = heapq.heappop(heap)
+            if problems == 0:
+                return state, True
+            if time.monotonic() > self.deadline:
+                break
+
+            # Missing items are placed first, in order; any other item
+            # moves at most once
+            slots = [i for i, item in enumerate(state) if item is None][:1]
+            if not slots:
+                # Items named by the most broken rules first, in case time
+                # runs out
+                failed = _problems(engine, room, self.slots, state)[1]
+                broken = Counter(kind for i, rule in enumerate(engine.rules)
+                                 if failed & (1 << i) for kind in rule.types)
+                slots = sorted((i for i in range(len(state)) if i not in done),
+                               key=lambda i: -broken[self.slots[i][0]])
+
+            # Batched checks take all of a layout's moves at once; one by
+            # one, the moves of the most likely items go first
+            groups = [slots] if self.columns is not None else [[slot] for slot in slots]
+            for group in groups:
+                children, moved_slots = [], []
+                for slot in group:
+                    for item in self._spots(slot, state):
+                        child = state[:slot] + (item,) + state[slot+1:]
+                        if child not in seen:
+                            seen.add(child)
+                            children.append(child)
+                            moved_slots.append(slot)
+                if not children:
+                    continue
+
+                for child, slot, (missing, failed) in zip(children, moved_slots, self._check(children)):
+                    if not (missing or failed) and moved + 1 <= f:
+                        # Nothing left on the heap can do better
+                        return child, True
+                    if (missing, bin(failed).count('1'), moved + 1) < (best[0], bin(best[1]).count('1'), best[2]):
+                        best = (missing, failed, moved + 1, child)
+                    tie += 1
+                    heapq.heappush(heap, priority(moved + 1, missing, failed) +
+                                   (tie, moved + 1, child, done | {slot}))
+                if time.monotonic() > self.deadline:
+                    return best[3], False
+
+        # Out of time, or no layout passes: the best one seen
+        return best[3], False
+
+
+class Repairer:
+    def __init__(self, engine, cache_size=CACHE_SIZE, time_budget=TIME_BUDGET):
+        self.engine = engine
+        self.cache_size = cache_size
+        self.time_budget = time_budget
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def suggest(self, room, by_type):
+        # Moves that fix a parsed layout, as {moves, complete, valid, feedback}.
+        # `complete` is false when the search ran out of time and the moves
+        # are only the best it found.
+        form = canonical(room, by_type)
+        with self._lock:
+            moves = self._cache.get(form.digest)
+            if moves is not None:
+                self._cache.move_to_end(form.digest)
+        if moves is not None:
+            # Cached moves are in the canonical orientation. Items that were
+            # missing must keep their usual footprint once turned back.
+            t = INVERSE[form.transform]
+            moves = [(kind, old and transform_rect(t, form.rows, form.cols, old),
+                      transform_rect(t, form.rows, form.cols, new))
+                     for kind, old, new in moves]
+            if any(old is None and new[2:] != self.engine.footprint(kind) for kind, old, new in moves):
+                moves = None
+            complete = True
+        if moves is None:
+            search = _Search(self.engine, room, by_type, time.monotonic() + self.time_budget)
+            state, complete = search.run()
+            moves = [(kind, old and _rect(old), _rect(new))
+                     for (kind, old), new in zip(search.slots, state) if new is not old]
+            if complete:
+                t = form.transform
+                with self._lock:
+                    self._cache[form.digest] = [
+                        (kind, old and transform_rect(t, room.rows, room.cols, old),
+                         transform_rect(t, room.rows, room.cols, new))
+                        for kind, old, new in moves]
+                    while len(self._cache) > self.cache_size:
+                        self._cache.popitem(last=False)
+
+        return self._result(room, by_type, moves, complete)
+
+    def _result(self, room, by_type, moves, complete):
+        engine = self.engine
+        fixed = {kind: list(items) for kind, items in by_type.items()}
+        for kind, old, (row, col, height, width) in moves:
+            same = fixed.setdefault(kind, [])
+            if old is not None:
+                same.remove(next(item for item in same if _rect(item) == old))
+            same.append(Item(kind, row, col, height, width, room.rect(row, col, height, width)))
+        missing = engine.missing(fixed)
+        feedback = engine.feedback(missing, 0 if missing else engine.failed(room, fixed))
+
+        return {
+            'moves': [{'type': kind,
+                       'from': old and {'row': old[0], 'col': old[1]},
+                       'to': {'row': new[0], 'col': new[1]}}
+                      for kind, old, new in moves],
+            'complete': complete,
+            'valid': feedback['valid'],
+            'feedback': feedback['feedback'],
+        }
@@ -0,0 +1,380 @@
+# Declarative, footprint-aware rule engine for room layouts.
+#
+# The grid, object footprints, walls and rules all come from one definition
+# (data/room_rules.json, also handed to the simulator page). It is compiled
+# once into bitmask predicates: every grid cell is one bit of a Python int,
+# so an item's footprint, the rows/columns it spans and the area around it
+# are plain ints, and each rule comes down to a few AND/OR operations.
+
+import hashlib
+import json
+import os
+from collections import namedtuple
+from functools import lru_cache
+
+from visibility import Sightlines
+
+DEFINITION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'room_rules.json')
+
+# Largest room accepted in a placement's "room" override
+MAX_ROOM_SIZE = 512
+
+# Footprint masks remembered per room
+RECT_CACHE_SIZE = 4096
+
+# Modules whose code decides verdicts (this one, line of sight, and the
+# vectorized checks the verdict table is built with), hashed into the
+# engine's version
+VERSION_SOURCES = ('rule_engine.py', 'visibility.py', 'placement_batch.py')
+
+Item = namedtuple('Item', 'type row col height width mask')
+
+# `types` must all be placed for the rule to apply; `watches` are the item
+# types whose changes can affect it (None for every type). For rules that
+# watch every type, `reach` tells whether a change to another item can
+# affect it.
+Rule = namedtuple('Rule', 'id message types watches broken reach')
+
+
+class Room:
+    def __init__(self, rows, cols, walls=()):
+        self.rows, self.cols = rows, cols
+        self.walls = tuple(walls)
+        self.full_row = (1 << cols) - 1
+
+        # _stack[h] repeats a one-row pattern over h consecutive rows
+        self._stack = [0] * (rows + 1)
+        for h in range(1, rows + 1):
+            self._stack[h] = self._stack[h-1] | (1 << ((h-1) * cols))
+        self._rects = {}
+
+        # Walls as one mask, and as per-row and per-column bitsets for
+        # line-of-sight checks (see visibility.py)
+        self.wall_mask = 0
+        self.wall_rows = [0] * rows
+        self.wall_cols = [0] * cols
+        for row, col, height, width in self.walls:
+            if not self.contains(row, col, height, width):
+                raise ValueError("Walls must lie inside the room.")
+            self.wall_mask |= self.rect(row, col, height, width)
+            for r in range(row, row + height):
+                self.wall_rows[r] |= ((1 << width) - 1) << col
+            for c in range(col, col + width):
+                self.wall_cols[c] |= ((1 << height) - 1) << row
+
+        self.perimeter = (self.rect(0, 0, 1, cols) | self.rect(rows-1, 0, 1, cols) |
+                          self.rect(0, 0, rows, 1) | self.rect(0, cols-1, rows, 1))
+
+    def contains(self, row, col, height, width):
+        return (0 <= row and 0 <= col and height > 0 and width > 0 and
+                row + height <= self.rows and col + width <= self.cols)
+
+    def rect(self, row, col, height, width):
+        key = (row, col, height, width)
+        mask = self._rects.get(key)
+        if mask is None:
+            if len(self._rects) >= RECT_CACHE_SIZE:
+                self._rects.clear()
+            line = ((1 << width) - 1) << col
+            mask = self._rects[key] = (line * self._stack[height]) << (row * self.cols)
+        return mask
+
+    def bands(self, item):
+        # Every cell sharing a row or a column with the item
+        rows = (self.full_row * self._stack[item.height]) << (item.row * self.cols)
+        cols = (((1 << item.width) - 1) << item.col) * self._stack[self.rows]
+        return rows | cols
+
+    def around(self, item, distance):
+        # Every cell within `distance` steps (Chebyshev) of the item
+        r0, c0 = max(0, item.row - distance), max(0, item.col - distance)
+        r1 = min(self.rows, item.row + item.height + distance)
+        c1 = min(self.cols, item.col + item.width + distance)
+        return self.rect(r0, c0, r1 - r0, c1 - c0)
+
+
+@lru_cache(maxsize=64)
+def _room(rows, cols, walls):
+    return Room(rows, cols, walls)
+
+
+def _int(value):
+    return type(value) is int
+
+
+def _wall(spec):
+    try:
+        wall = (spec['row'], spec['col'], spec.get('height', 1), spec.get('width', 1))
+    except (TypeError, KeyError, AttributeError):
+        raise ValueError("Walls need a row and a col.")
+    if not all(_int(v) for v in wall):
+        raise ValueError("Wall coordinates must be whole numbers.")
+    return wall
+
+
+# Pair predicates shared by the rule checks. `sight` is the layout's
+# visibility.Sightlines; walls and other furniture block the view.
+
+def is_facing(room, item1, item2, sight):
+    # Items face each other when they share a row or a column and can see
+    # each other
+    return room.bands(item1) & item2.mask != 0 and sight.clear(item1, item2)
+
+def is_aligned(room, item1, item2, sight):
+    # Foot of the bed pointing at the door: same rows or columns, nothing
+    # in between
+    return room.bands(item1) & item2.mask != 0 and sight.clear(item1, item2)
+
+def has_clear_view(room, item1, item2, max_distance, sight):
+    # item2 is no further than max_distance cells from item1, and nothing
+    # is in the way
+    return room.around(item1, max_distance) & item2.mask != 0 and sight.clear(item1, item2)
+
+
+# Rule checks. Each factory takes the rule's spec and returns a predicate
+# that is true when the rule is broken.
+
+def _on_perimeter(spec):
+    kind, = spec['items']
+    def broken(room, by_type, sight):
+        return any(item.mask & room.perimeter == 0 for item in by_type[kind])
+    return broken
+
+def _pair_check(test):
+    def factory(spec):
+        first, second = spec['items']
+        def broken(room, by_type, sight):
+            others = by_type[second]
+            return any(test(room, a, b, sight) for a in by_type[first] for b in others)
+        return broken
+    return factory
+
+def _clear_view(spec):
+    first, second = spec['items']
+    distance = spec['distance']
+    def broken(room, by_type, sight):
+        others = by_type[second]
+        return not all(any(has_clear_view(room, a, b, distance, sight) for b in others)
+                       for a in by_type[first])
+    return broken
+
+def _no_overlap(spec):
+    def broken(room, by_type, sight):
+        occupied = room.wall_mask
+        for items in by_type.values():
+            for item in items:
+                if occupied & item.mask:
+                    return True
+                occupied |= item.mask
+        return False
+    return broken
+
+CHECKS = {
+    'on_perimeter': _on_perimeter,
+    'not_aligned': _pair_check(is_aligned),
+    'not_facing': _pair_check(is_facing),
+    'clear_view': _clear_view,
+    'no_overlap': _no_overlap,
+}
+
+# Checks that look at every item in the room, not just the rule's own types
+# (other furniture can block a line of sight)
+WATCH_ALL = {'not_aligned', 'not_facing', 'clear_view', 'no_overlap'}
+
+
+# Reach of the WATCH_ALL checks. Each factory takes the rule's spec and
+# returns a predicate on `changed`, the old and new placements of another
+# item that changed (as Items): false when the change can't affect the
+# rule. They compare coordinates, not masks, as they run on every change.
+# Overlaps have no reach: any change can start or stop one, and the check
+# is a single pass over the items' masks, so it is always re-run.
+
+def _sight_reach(near):
+    # Other items only matter as blockers of the pairs close enough for
+    # their sightline to count, and a sightline stays inside the rectangle
+    # spanning its two items
+    def factory(spec):
+        first, second = spec['items']
+        distance = spec.get('distance', 0)
+        def reach(room, by_type, changed):
+            others = by_type.get(second, ())
+            for a in by_type.get(first, ()):
+                for b in others:
+                    if not near(a, b, distance):
+                        continue
+                    r0, c0 = min(a.row, b.row), min(a.col, b.col)
+                    r1 = max(a.row + a.height, b.row + b.height)
+                    c1 = max(a.col + a.width, b.col + b.width)
+                    for item in changed:
+                        if (item.row < r1 and r0 < item.row + item.height and
+                                item.col < c1 and c0 < item.col + item.width):
+                            return True
+            return False
+        return reach
+    return factory
+
+def _in_line(item1, item2, distance):
+    # room.bands(item1) & item2.mask, as coordinates
+    return (item1.row < item2.row + item2.height and item2.row < item1.row + item1.height or
+            item1.col < item2.col + item2.width and item2.col < item1.col + item1.width)
+
+def _within(item1, item2, distance):
+    # room.around(item1, distance) & item2.mask, as coordinates
+    return (item1.row - distance < item2.row + item2.height and
+            item2.row < item1.row + item1.height + distance and
+            item1.col - distance < item2.col + item2.width and
+            item2.col < item1.col + item1.width + distance)
+
+REACHES = {
+    'not_aligned': _sight_reach(_in_line),
+    'not_facing': _sight_reach(_in_line),
+    'clear_view': _sight_reach(_within),
+}
+
+
+class RuleEngine:
+    def __init__(self, definition):
+        self.definition = definition
+        grid = definition['grid']
+        self.room = Room(grid['rows'], grid['cols'],
+                         [_wall(w) for w in definition.get('walls', [])])
+        self.objects = definition['objects']
+        self._footprints = {kind: (spec.get('height', 1), spec.get('width', 1))
+                            for kind, spec in self.objects.items()}
+        self.required = list(definition['required'])
+        self.success = definition['success']
+
+        self.rules = []
+        for spec in definition['rules']:
+            if spec['check'] not in CHECKS:
+                raise ValueError(f"Unknown rule check: {spec['check']}")
+            types = frozenset(spec['items'])
+            if spec['check'] in WATCH_ALL:
+                reach = REACHES.get(spec['check'])
+                watches, reach = None, reach and reach(spec)
+            else:
+                watches, reach = types, None
+            self.rules.append(Rule(spec['id'], spec['message'], types, watches,
+                                   CHECKS[spec['check']](spec), reach))
+        self.messages = [rule.message for rule in self.rules]
+        self._dependents = {}
+
+        # Changes whenever the definition or the code checking it does
+        digest = hashlib.sha256(json.dumps(definition, sort_keys=True).encode())
+        for name in VERSION_SOURCES:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), 'rb') as f:
+                digest.update(f.read())
+        self.version = digest.digest()
+
+    @classmethod
+    def from_file(cls, path=DEFINITION_PATH):
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def footprint(self, kind):
+        # Default (height, width) of an item type
+        return self._footprints.get(kind, (1, 1))
+
+    def room_for(self, spec):
+        # Room for a placement's "room" override: {rows, cols, walls}
+        try:
+            rows, cols = spec['rows'], spec['cols']
+            walls = tuple(_wall(w) for w in spec.get('walls', []))
+        except (TypeError, KeyError, AttributeError):
+            raise ValueError("A room needs rows and cols.")
+        if not (_int(rows) and _int(cols) and 0 < rows <= MAX_ROOM_SIZE and 0 < cols <= MAX_ROOM_SIZE):
+            raise ValueError(f"Rooms must be between 1 and {MAX_ROOM_SIZE} cells on each side.")
+        return _room(rows, cols, walls)
+
+    def item(self, room, kind, spec):
+        height, width = self._footprints.get(kind, (1, 1))
+        try:
+            row, col = spec['row'], spec['col']
+            height = spec.get('height', height)
+            width = spec.get('width', width)
+        except (TypeError, KeyError, AttributeError):
+            raise ValueError(f"The {kind} needs a row and a col.")
+        if not (_int(row) and _int(col) and _int(height) and _int(width)):
+            raise ValueError(f"The {kind} must be placed on whole grid cells.")
+        if not room.contains(row, col, height, width):
+            raise ValueError(f"The {kind} must fit inside the room.")
+        return Item(kind, row, col, height, width, room.rect(row, col, height, width))
+
+    def parse(self, placement):
+        # Returns the room and the placed items grouped by type. Each type maps
+        # to one item, or to a list of items of that type.
+        if not isinstance(placement, dict):
+            raise ValueError("A placement must be an object of items.")
+        room = self.room
+        if 'room' in placement:
+            room = self.room_for(placement['room'])
+
+        by_type = {}
+        for kind, value in placement.items():
+            if kind == 'room':
+                continue
+            specs = value if isinstance(value, list) else [value]
+            if specs:
+                by_type[kind] = [self.item(room, kind, spec) for spec in specs]
+        return room, by_type
+
+    def missing(self, by_type):
+        # Bit i is set when required[i] has not been placed
+        mask = 0
+        for i, req in enumerate(self.required):
+            if req not in by_type:
+                mask |= 1 << i
+        return mask
+
+    def failed(self, room, by_type, sight=None):
+        # Bit i is set when rules[i] is broken. Rules about item types that
+        # aren't in the room don't apply.
+        if sight is None:
+            sight = Sightlines(room, by_type)
+        mask = 0
+        for i, rule in enumerate(self.rules):
+            if rule.types <= by_type.keys() and rule.broken(room, by_type, sight):
+                mask |= 1 << i
+        return mask
+
+    def rule_broken(self, i, room, by_type, sight):
+        rule = self.rules[i]
+        return rule.types <= by_type.keys() and rule.broken(room, by_type, sight)
+
+    def dependents(self, kind):
+        # Indexes of the rules a change to an item of this type can affect
+        rules = self._dependents.get(kind)
+        if rules is None:
+            rules = self._dependents[kind] = tuple(
+                i for i, rule in enumerate(self.rules)
+                if rule.watches is None or kind in rule.watches)
+        return rules
+
+    def affected(self, kind, changed, room, by_type):
+        # Indexes of the rules a change to items of this type can affect,
+        # given their old and new placements (`changed`, as Items) and
+        # by_type as it is after the change: those about the type, those
+        # about others that the change comes within reach of, and those
+        # with no reach (no_overlap)
+        rules = self.rules
+        return [i for i in self.dependents(kind)
+                if kind in rules[i].types or rules[i].reach is None or rules[i].reach(room, by_type, changed)]
+
+    def feedback(self, missing, failed):
+        # Build the response body for a missing-item mask and a failed-rule mask
+        if missing:
+            feedback = [f"You must place a {req} in the room."
+                        for i, req in enumerate(self.required) if missing & (1 << i)]
+            return {'valid': False, 'feedback': feedback}
+
+        feedback = [msg for i, msg in enumerate(self.messages) if failed & (1 << i)]
+        if not feedback:
+            return {'valid': True, 'feedback': [self.success]}
+        return {'valid': False, 'feedback': feedback}
+
+    def validate(self, placement):
+        room, by_type = self.parse(placement)
+        missing = self.missing(by_type)
+        if missing:
+            return self.feedback(missing, 0)
+        return self.feedback(0, self.failed(room, by_type))
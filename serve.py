@@ -0,0 +1,262 @@
+# Production server: a pre-forking master with threaded workers.
+#
+#   python serve.py [--host 0.0.0.0] [--port 8000] [--workers 4] [--threads 8]
+#
+# The master loads the app once: importing server.py reads the content,
+# compiles the rules, maps the verdict table and loads the quiz bank. It
+# then compiles every template, through a Jinja bytecode cache in the
+# app's instance folder so later starts skip the compiler too, renders the
+# cached pages, and freezes the heap out of the garbage collector before
+# forking. Workers share all of that copy-on-write and accept on the
+# master's socket, each handling requests on a fixed pool of threads and
+# starting the app's background threads (the answer log's writer, the
+# challenge generator) for itself. A worker stops accepting while it has
+# QUEUED_PER_THREAD connections per thread waiting, leaving the rest to
+# other workers. Each connection serves one request (HTTP/1.0), so idle
+# keep-alive clients can't tie up the pool; put a proxy in front for
+# keep-alive.
+#
+# Signals to the master:
+#   SIGHUP           reload: the master re-executes itself on the same
+#                    socket, loading code, templates and content afresh;
+#                    once the new workers are up the old ones finish their
+#                    requests and exit. If loading fails the old workers
+#                    keep serving.
+#   SIGTERM, SIGINT  stop once in-flight requests are done.
+# Workers that die are replaced.
+#
+# In-process state is per worker: validation sessions, the challenge pool
+# and the caches. The simulator starts a new validation session when a
+# delta reaches a worker that doesn't know its session, so with several
+# workers live validation costs more; one worker with more threads avoids it.
+
+import argparse
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+log = logging.getLogger('serve')
+
+# Seconds a stopping worker gets to finish its requests
+GRACEFUL_TIMEOUT = 30
+
+# How the listening socket and the workers to retire are handed to the
+# master that replaces this one on reload
+FD_ENV = 'FENGSHUIFY_SERVE_FD'
+OLD_WORKERS_ENV = 'FENGSHUIFY_SERVE_OLD_WORKERS'
+
+# Tells server.py to leave its background threads to the workers
+PREFORK_ENV = 'FENGSHUIFY_PREFORK'
+
+# Connections a worker takes on per request thread before it stops
+# accepting: the rest wait in the socket's backlog for a worker with room
+QUEUED_PER_THREAD = 4
+
+
+class _Handler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+
+class _PoolServer(BaseWSGIServer):
+    # Werkzeug's server, handing connections to a fixed pool of threads
+    multithread = True
+
+    def __init__(self, host, port, app, fd, threads):
+        super().__init__(host, port, app, handler=_Handler, fd=fd)
+        self.pool = ThreadPoolExecutor(threads, thread_name_prefix='request')
+        # Accepted connections not yet answered; the accept loop waits for
+        # a slot, so a busy worker doesn't hoard connections others could
+        # serve
+        self.slots = threading.BoundedSemaphore(threads * QUEUED_PER_THREAD)
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.pool.submit(self._handle, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _handle(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+def load():
+    # Import and warm the app in this process, before any fork
+    os.environ[PREFORK_ENV] = '1'
+    from server import app, lessons, orientation_games
+
+    # Under the instance folder, which FENGSHUIFY_INSTANCE_PATH can move
+    cache_dir = os.path.join(app.instance_path, 'jinja_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    # Fill the page cache
+    urls = ['/', '/learn/overview', '/quiz', '/simulator', '/about']
+    urls += [f'/learn/{lesson}' for lesson in range(1, len(lessons) + 2)]
+    urls += [f'/orientation_game/{section}' for section in orientation_games]
+    client = app.test_client()
+    for url in urls:
+        response = client.get(url)
+        response.close()
+        if response.status_code != 200:
+            log.warning("Warming %s answered %d", url, response.status_code)
+    return app
+
+
+def worker(app, host, port, fd, threads):
+    # Serve until SIGTERM, then finish the requests already accepted
+    from server import start_background
+
+    start_background()
+    server = _PoolServer(host, port, app, fd, threads)
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever, which this thread is running
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    status = 0
+    try:
+        server.serve_forever()
+        server.pool.shutdown(wait=True)
+    except Exception:
+        log.exception("Worker failed")
+        status = 1
+    finally:
+        os._exit(status)
+
+
+class Master:
+    def __init__(self, args, sock):
+        self.args = args
+        self.sock = sock
+        self.app = None
+        self.workers = set()
+        self.stopping = self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            worker(self.app, self.args.host, self.args.port, self.sock.fileno(), self.args.threads)
+        self.workers.add(pid)
+
+    def _signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.reloading = True
+        else:
+            self.stopping = True
+
+    def run(self, retiring):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signal)
+
+        try:
+            self.app = load()
+        except Exception:
+            if not retiring:
+                raise
+            # A broken reload: keep the old workers, wait for the next one
+            log.exception("Reload failed; the previous workers keep serving")
+            self.workers, retiring = set(retiring), []
+        else:
+            gc.freeze()
+            for _ in range(self.args.workers):
+                self.spawn()
+            for pid in retiring:
+                _kill(pid, signal.SIGTERM)
+            log.info("Serving on http://%s:%d with %d workers of %d threads (master %d)",
+                     self.args.host, self.args.port, self.args.workers, self.args.threads, os.getpid())
+
+        while not self.stopping:
+            if self.reloading:
+                self.reload()
+            self.reap()
+            time.sleep(0.5)
+        self.stop()
+
+    def reap(self):
+        # Replace workers that died; retired ones are just collected
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if not self.stopping and self.app is not None:
+                    log.warning("Worker %d exited (status %d); starting another", pid, status)
+                    self.spawn()
+
+    def reload(self):
+        # Become a fresh master on the same socket; the current workers
+        # serve until the new ones are up
+        log.info("Reloading")
+        os.environ[FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(map(str, self.workers))
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def stop(self):
+        for pid in self.workers:
+            _kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.workers:
+            _kill(pid, signal.SIGKILL)
+
+
+def _kill(pid, signum):
+    try:
+        os.kill(pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the app with pre-forked, threaded workers.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: one per CPU)")
+    parser.add_argument('--threads', type=int, default=8, help="request threads per worker")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='[%(process)d] %(message)s')
+
+    # A reloaded master inherits its socket and the workers to retire
+    if FD_ENV in os.environ:
+        sock = socket.socket(fileno=int(os.environ.pop(FD_ENV)))
+        retiring = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid]
+    else:
+        family = socket.AF_INET6 if ':' in args.host else socket.AF_INET
+        sock = socket.create_server((args.host, args.port), family=family, backlog=2048)
+        retiring = []
+    sock.set_inheritable(True)
+
+    Master(args, sock).run(retiring)
+
+
+if __name__ == '__main__':
+    main()
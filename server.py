@@ -1,6 +1,77 @@
-from flask import Flask, render_template, jsonify, request, url_for
+import json
+import os
+import secrets
+import time
 
-app = Flask(__name__)
+from flask import Flask, render_template, jsonify, request, url_for, Response, stream_with_context
+
+import verdict_table
+from placement import engine, feedback_for
+from placement_batch import validate_batch, parse_ndjson, dump_json, dump_ndjson
+from sessions import SessionStore
+from qi_flow import QiFlow
+from repair import Repairer
+from puzzles import ChallengePool
+from page_cache import PageCache
+from assets import Assets
+from quiz_bank import MAX_SEED, QuizBank, read_lines
+from analytics import AnswerLog
+from gallery import MAX_PAGE_SIZE, PAGE_SIZE, Gallery
+from thumbnails import CELL_SIZE, Thumbnails, cell_size
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, Metrics
+
+# FENGSHUIFY_INSTANCE_PATH (an absolute path) moves instance/, and the
+# stores below with it, somewhere else
+app = Flask(__name__, instance_path=os.environ.get('FENGSHUIFY_INSTANCE_PATH'))
+# FLASK_-prefixed environment variables, e.g. FLASK_METRICS_PROFILE_RATE
+app.config.from_prefixed_env()
+started = time.time()
+
+# Request latency and rule failure metrics for /metrics, see metrics.py
+metrics = Metrics(app, engine)
+
+# Optimized images and other built files, see assets.py
+assets = Assets(app)
+
+# Precomputed verdicts, if `python verdict_table.py` has been run
+verdicts = verdict_table.load()
+
+# Rooms being validated incrementally, see sessions.py
+validation_sessions = SessionStore(engine)
+
+# Cached qì-flow heatmaps, see qi_flow.py
+qi_flow = QiFlow()
+
+# Cached repair hints, see repair.py
+repairer = Repairer(engine)
+
+# Quiz questions from data/quiz, see quiz_bank.py
+quiz_bank = QuizBank()
+
+# Answers to the quiz and orientation games, written behind to
+# instance/analytics.sqlite3, see analytics.py
+answer_log = AnswerLog(os.path.join(app.instance_path, 'analytics.sqlite3'))
+
+# Saved layouts, see gallery.py
+gallery = Gallery(engine, os.path.join(app.instance_path, 'gallery.sqlite3'))
+
+# Layout thumbnails, kept in memory and under instance/thumbnails, see
+# thumbnails.py
+thumbnails = Thumbnails(engine, disk_dir=os.path.join(app.instance_path, 'thumbnails'))
+
+# "Fix this room" challenges, generated in the background, see puzzles.py
+challenges = ChallengePool(engine)
+
+
+def start_background():
+    # The answer log's writer and the challenge generator. serve.py sets
+    # FENGSHUIFY_PREFORK so its master doesn't fork with them running, and
+    # calls this in each worker instead.
+    answer_log.start()
+    challenges.start()
+
+if not os.environ.get('FENGSHUIFY_PREFORK'):
+    start_background()
 
 learn_sections = [
     {
@@ -227,37 +298,54 @@ orientation_games = {
     }
 }
 
+# Rendered pages, see page_cache.py. They're rebuilt when the templates or
+# any of this content changes.
+pages = PageCache(app, lambda: (learn_sections, lessons, orientation_games, engine.definition,
+                                assets.manifest, quiz_bank.questions))
+
+# Lesson 1 is learn_sections, lessons 2 and up are `lessons`
+def known_lesson(lesson):
+    return lesson in {str(i) for i in range(1, len(lessons) + 2)}
+
 
 @app.route('/')
+@pages.cached()
 def home():
     return render_template('index.html')
 
 @app.route('/learn/overview')
+@pages.cached()
 def learn_overview():
     return render_template('learn_overview.html')
 
 @app.route('/learn/<lesson>')
+@pages.cached(when=known_lesson)
 def learn(lesson):
     return render_template('learn.html', lesson=lesson,
-        learn_sections=learn_sections, lessons=lessons)
+        learn_sections=assets.resolve(learn_sections, 'image'),
+        lessons=assets.resolve(lessons, 'image'))
 
 @app.route('/quiz')
+@pages.cached()
 def quiz():
-    return render_template('quiz.html')
+    return render_template('quiz.html', questions=quiz_bank.public(quiz_bank.quiz()))
 
 @app.route('/mini_simulator/<part>')
 def mini_simulator(part):
     return render_template('mini_simulator.html', part=part)
 
 @app.route('/simulator')
+@pages.cached()
 def simulator():
-    return render_template('simulator.html')
+    return render_template('simulator.html', room_rules=engine.definition)
 
 @app.route('/about')
+@pages.cached()
 def about():
     return render_template('about.html')
 
 @app.route('/orientation_game/<section>')
+@pages.cached()
 def orientation_game(section):
     if section not in orientation_games:
         return "Game not found", 404
@@ -268,7 +356,7 @@ def orientation_game(section):
                           section=section,
                           section_name=game_data["section_name"],
                           game_instruction=game_data["game_instruction"],
-                          choices=game_data["choices"])
+                          choices=assets.resolve(game_data["choices"], 'image_url'))
 
 # API endpoint to check orientation game answers
 @app.route('/check_orientation', methods=['POST'])
@@ -281,6 +369,7 @@ def check_orientation():
     
     game_data = orientation_games[section]
     is_correct = choice == game_data["correct"]
+    answer_log.record('orientation', section, choice, is_correct)
     
     return jsonify({
         "correct": is_correct,
@@ -288,168 +377,307 @@ def check_orientation():
         "correct_label": game_data["correct_label"]
     })
 
-# stores user's quiz answers
+# Grades the quiz form: the default quiz, or the random one drawn from the
+# form's seed and count
 @app.route('/submit_quiz', methods=['POST'])
 def submit_quiz():
-    correct_answers = {
-        'q1': 'b',
-        'q2': 'a',
-        'q3': 'c',
-        'q4': 'b',
-        'q5': 'c'
-    }
-    
-    # Question texts and answer choices to provide better feedback
-    questions = {
-        'q1': {
-            'text': 'What is the main goal of Feng Shui?',
-            'a': 'To decorate a room in traditional Chinese style',
-            'b': 'To manipulate the environment to maximize good energy flow',
-            'c': 'To organize furniture in a symmetrical pattern'
-        },
-        'q2': {
-            'text': 'According to Feng Shui principles, how should the front door be positioned?',
-            'a': 'It should be the largest door in the house and in a brightly lit, open entryway',
-            'b': 'It should be small and dark to prevent negative energy from entering',
-            'c': 'It should always face north to align with magnetic energy'
-        },
-        'q3': {
-            'text': 'According to Feng Shui principles, how should a bed be positioned?',
-            'a': 'With the foot of the bed pointed directly at the door for proper energy flow',
-            'b': 'Directly under a window to maximize natural light',
-            'c': 'Not with the foot pointed at the door, but with a clear view of the door'
-        },
-        'q4': {
-            'text': 'How should mirrors be placed according to Feng Shui principles?',
-            'a': 'Directly facing the bed to reflect positive energy',
-            'b': 'Not facing the bed or bedroom door, and not hung right above the bed',
-            'c': 'Opposite the door to bounce energy back into the room'
-        },
-        'q5': {
-            'text': 'What does the concept of qì (气) represent in Feng Shui?',
-            'a': 'The color scheme used in interior design',
-            'b': 'The arrangement of furniture in a room',
-            'c': 'The flow of energy throughout the universe'
-        }
-    }
-    
     user_answers = request.form
-    score = 0
-    incorrect = []
-    
+    try:
+        numbers = quiz_bank.quiz(user_answers.get('count'), user_answers.get('seed'))
+        score, wrong, unanswered = quiz_bank.grade(numbers, user_answers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    total = len(numbers)
+
     # Check if all questions are answered
-    all_answered = all(q in user_answers for q in correct_answers.keys())
-    
-    if not all_answered:
+    if unanswered:
         return jsonify({
-            'score': score,
-            'total': len(correct_answers),
+            'score': 0,
+            'total': total,
             'message': "Please answer all questions to get accurate results.",
             'incorrect': []
         })
-    
-    for q, correct_ans in correct_answers.items():
-        if q in user_answers:
-            user_choice = user_answers[q]
-            is_correct = user_choice == correct_ans
-            
-            if is_correct:
-                score += 1
-            else:
-                incorrect.append({
-                    'question': questions[q]['text'],
-                    'user_answer': questions[q][user_choice],
-                    'correct_answer': questions[q][correct_ans]
-                })
-    
+
+    wrong_choices = dict(wrong)
+    for i in numbers:
+        choice = wrong_choices.get(i, quiz_bank.key[i])
+        answer_log.record('quiz', quiz_bank.questions[i].id, choice, i not in wrong_choices)
+
+    incorrect = [{
+        'question': quiz_bank.questions[i].text,
+        'user_answer': quiz_bank.choice_text(i, choice),
+        'correct_answer': quiz_bank.choice_text(i, quiz_bank.key[i])
+    } for i, choice in wrong]
+
     # Create appropriate message based on score
-    if score == 5:
+    if score == total:
         message = "Perfect! You've mastered Feng Shui principles!"
-    elif score >= 3:
+    elif score >= 0.6 * total:
         message = "Good job! You have a solid understanding of Feng Shui."
     else:
         message = "You might want to review the Feng Shui lessons again."
-    
+
     return jsonify({
         'score': score,
-        'total': len(correct_answers),
+        'total': total,
         'message': message,
         'incorrect': incorrect
     })
 
+# A random quiz: `count` questions (all by default) drawn with `seed`, or
+# with a fresh seed that's returned for the answers to be submitted with
+@app.route('/quiz/questions', methods=['GET'])
+def quiz_questions():
+    seed = request.args.get('seed')
+    if seed is None:
+        seed = secrets.randbelow(MAX_SEED)
+    try:
+        numbers = quiz_bank.quiz(request.args.get('count', len(quiz_bank)), seed)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'seed': int(seed), 'count': len(numbers), 'questions': quiz_bank.public(numbers)})
+
+# Grades a whole class at once: NDJSON submissions in, one NDJSON result per
+# submission out, streamed as they're read
+@app.route('/quiz/grade', methods=['POST'])
+def grade_quizzes():
+    if request.mimetype != 'application/x-ndjson':
+        return jsonify({"error": "Send submissions as application/x-ndjson"}), 415
+    return Response(stream_with_context(quiz_bank.grade_stream(read_lines(request.stream))),
+                    mimetype='application/x-ndjson')
+
 @app.route('/validate_placement', methods=['POST'])
 def validate_placement():
     # Get placement data from request
     placement = request.json
-    
-    # Validation feedback
-    feedback = []
-    
-    # Define grid size
-    grid_rows, grid_cols = 8, 8
-    
-    # Required unique items
-    required = ['door', 'bed', 'desk', 'mirror']
-    for req in required:
-        if req not in placement:
-            feedback.append(f"You must place a {req} in the room.")
-    
-    # If missing required items, return early
-    if feedback:
-        return jsonify({ 'valid': False, 'feedback': feedback })
-    
-    door = placement['door']
-    bed = placement['bed']
-    desk = placement['desk']
-    mirror = placement['mirror']
-    
-    # 1. Door must be on perimeter (exterior wall)
-    dr, dc = door['row'], door['col']
-    if not (dr == 0 or dr == grid_rows-1 or dc == 0 or dc == grid_cols-1):
-        feedback.append("The door must sit on an exterior wall (room perimeter).")
-    
-    # 2. Bed should not be directly aligned (facing) with the door
-    if is_aligned(bed, door):
-        feedback.append("The bed should not be directly aligned with the door.")
-    
-    # 3. Mirror should not face the bed
-    if is_facing(mirror, bed):
-        feedback.append("The mirror should not face the bed.")
-    
-    # 4. Mirror should not face the door (prevents qi bouncing out)
-    if is_facing(mirror, door):
-        feedback.append("The mirror should not face the door.")
-    
-    # 5. Desk should have a clear view of the door (within 5 cells)
-    if not has_clear_view(desk, door):
-        feedback.append("The desk should have a clear view of the door.")
-    
-    # If no negative feedback, add positive message
-    if not feedback:
-        feedback.append("Great job! Your room has good Feng Shui energy flow. You've successfully learned the basic concepts of Feng Shui!")
-    
+
+    # Single-cell layouts are answered straight from the verdict table
+    if verdicts is not None:
+        with metrics.timer('rule_evaluation_seconds', source='table'):
+            failed = verdicts.lookup(placement)
+        if failed is not None:
+            metrics.record_verdict(0, failed)
+            return jsonify(feedback_for(0, failed))
+
+    try:
+        with metrics.timer('rule_evaluation_seconds', source='rules'):
+            room, by_type = engine.parse(placement)
+            missing = engine.missing(by_type)
+            failed = 0 if missing else engine.failed(room, by_type)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    metrics.record_verdict(missing, failed)
+    return jsonify(feedback_for(missing, failed))
+
+# Validates many layouts in one request, as a JSON array or as NDJSON
+@app.route('/validate_placement/batch', methods=['POST'])
+def validate_placement_batch():
+    ndjson = request.mimetype == 'application/x-ndjson'
+    try:
+        if ndjson:
+            layouts = parse_ndjson(request.get_data(as_text=True))
+        else:
+            layouts = request.get_json()
+    except ValueError:
+        return jsonify({"error": "Malformed layout data"}), 400
+
+    if not isinstance(layouts, list):
+        return jsonify({"error": "Expected a list of layouts"}), 400
+
+    results = validate_batch(layouts)
+    if ndjson:
+        return Response(dump_ndjson(results), mimetype='application/x-ndjson')
+    # As jsonify would, but encoding each shared response only once
+    return Response(dump_json(results, lambda result: app.json.dumps(result, separators=(',', ':'))),
+                    mimetype='application/json')
+
+# Starts an incremental validation session for a room
+@app.route('/validation_sessions', methods=['POST'])
+def create_validation_session():
+    try:
+        session_id, session = validation_sessions.create(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'session': session_id, **session.feedback}), 201
+
+@app.route('/validation_sessions/<session_id>', methods=['GET'])
+def get_validation_session(session_id):
+    session = validation_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+    with session.lock:
+        return jsonify(session.feedback)
+
+# Applies add/move/remove deltas and returns only the feedback that changed
+@app.route('/validation_sessions/<session_id>/deltas', methods=['POST'])
+def update_validation_session(session_id):
+    session = validation_sessions.get(session_id)
+    if session is None:
+        return jsonify({"error": "Session not found"}), 404
+
+    body = request.get_json()
+    deltas = body.get('deltas') if isinstance(body, dict) and 'deltas' in body else [body]
+    if not isinstance(deltas, list):
+        return jsonify({"error": "Expected a list of deltas"}), 400
+
+    with session.lock:
+        try:
+            return jsonify(session.update(deltas))
+        except ValueError as e:
+            return jsonify({"error": str(e), **session.feedback}), 400
+
+@app.route('/validation_sessions/<session_id>', methods=['DELETE'])
+def delete_validation_session(session_id):
+    if not validation_sessions.delete(session_id):
+        return jsonify({"error": "Session not found"}), 404
+    return '', 204
+
+# Heatmap of qì flowing from the door through a layout
+@app.route('/qi_flow', methods=['POST'])
+def qi_flow_heatmap():
+    try:
+        room, by_type = engine.parse(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if 'door' not in by_type:
+        return jsonify({"error": "Place a door to see how qì flows."}), 400
+
+    field = qi_flow.field(room, by_type)
     return jsonify({
-        'valid': len(feedback) == 1 and "Great job" in feedback[0],
-        'feedback': feedback
+        'rows': room.rows,
+        'cols': room.cols,
+        'field': field.round(3).tolist()
     })
 
-def is_facing(item1, item2):
-    # Check if items are facing each other
-    # In our simplified model, we'll just check if they're on the same row or column
-    return (item1['row'] == item2['row'] or item1['col'] == item2['col'])
-
-def is_aligned(item1, item2):
-    # Check if items are directly aligned
-    # This would mean foot of bed pointing to door
-    return (item1['row'] == item2['row'] or item1['col'] == item2['col'])
-
-def has_clear_view(item1, item2):
-    # Check if item1 has clear view of item2
-    # In our simplified model, this means they're not too far apart
-    max_distance = 5  # Define maximum distance for "clear view"
-    row_dist = abs(item1['row'] - item2['row'])
-    col_dist = abs(item1['col'] - item2['col'])
-    return row_dist <= max_distance and col_dist <= max_distance
+# Fewest moves that make a layout pass every rule
+@app.route('/validate_placement/fix', methods=['POST'])
+def suggest_fix():
+    try:
+        room, by_type = engine.parse(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(repairer.suggest(room, by_type))
+
+# Saves a simulator layout for sharing; a rotation or reflection of a saved
+# layout gets the saved one's id
+@app.route('/gallery', methods=['POST'])
+def save_layout():
+    try:
+        layout_id, created, feedback = gallery.save(request.get_json())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({'id': layout_id, 'created': created, **feedback}), 201 if created else 200
+
+# Saved layouts, newest first. `before` is the previous page's `next`.
+@app.route('/gallery', methods=['GET'])
+def list_layouts():
+    before = request.args.get('before', type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    valid = request.args.get('valid')
+    if valid not in (None, 'true', 'false'):
+        return jsonify({"error": "valid must be true or false"}), 400
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_PAGE_SIZE}"}), 400
+
+    layouts, cursor = gallery.page(before, None if valid is None else valid == 'true', limit)
+    return jsonify({'layouts': layouts, 'next': cursor})
+
+@app.route('/gallery/<int:layout_id>', methods=['GET'])
+def get_layout(layout_id):
+    layout = gallery.get(layout_id)
+    if layout is None:
+        return jsonify({"error": "Layout not found"}), 404
+    return jsonify(layout)
+
+# Seconds browsers may reuse a thumbnail before checking its ETag
+THUMBNAIL_MAX_AGE = 60 * 60
+
+def send_thumbnail(placement):
+    # PNG of a placement, with `cell` (pixels per cell) and `overlay`
+    # (show the verdict) from the query string
+    try:
+        room, by_type = engine.parse(placement)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    cell = cell_size(room, request.args.get('cell', CELL_SIZE, type=int))
+    overlay = request.args.get('overlay') in ('1', 'true')
+
+    etag = thumbnails.etag(room, by_type, cell, overlay)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(thumbnails.png(etag, room, by_type, cell, overlay), mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = THUMBNAIL_MAX_AGE
+    return response
+
+# Thumbnail of any layout, given as JSON in `layout` (as for
+# /validate_placement, so challenges can send their room and locked items)
+@app.route('/thumbnail.png', methods=['GET'])
+def layout_thumbnail():
+    try:
+        placement = json.loads(request.args.get('layout', ''))
+    except ValueError:
+        return jsonify({"error": "layout must be a JSON placement"}), 400
+    return send_thumbnail(placement)
+
+@app.route('/gallery/<int:layout_id>/thumbnail.png', methods=['GET'])
+def saved_layout_thumbnail(layout_id):
+    layout = gallery.get(layout_id)
+    if layout is None:
+        return jsonify({"error": "Layout not found"}), 404
+    return send_thumbnail(layout['placement'])
+
+# Error rates per quiz question and orientation-game section, and how the
+# answer log's writer is keeping up
+@app.route('/analytics/stats', methods=['GET'])
+def analytics_stats():
+    return jsonify(answer_log.stats())
+
+# Generator throughput and pool refill times. Registered before the tier
+# route so "stats" isn't taken for a tier.
+@app.route('/challenges/stats', methods=['GET'])
+def challenge_stats():
+    return jsonify(challenges.stats())
+
+# A ready challenge from a difficulty tier; never waits on generation
+@app.route('/challenges/<tier>', methods=['GET'])
+def get_challenge(tier):
+    try:
+        challenge = challenges.take(tier)
+    except KeyError:
+        return jsonify({"error": "Unknown difficulty"}), 404
+    if challenge is None:
+        return jsonify({"error": "No challenges ready yet, try again shortly."}), 503
+    return jsonify(challenge)
+
+# Numbers the rest of the app already keeps, read when /metrics is scraped
+metrics.report('page_cache_requests_total', 'counter', "Cacheable page requests, by result.",
+               lambda: {(('result', 'hit'),): pages.hits, (('result', 'miss'),): pages.misses})
+metrics.report('thumbnail_requests_total', 'counter', "Thumbnails drawn or found, by where they came from.",
+               lambda: {(('result', 'memory'),): thumbnails.hits, (('result', 'disk'),): thumbnails.disk_hits,
+                        (('result', 'drawn'),): thumbnails.misses})
+metrics.report('thumbnail_disk_bytes', 'gauge', "Bytes of thumbnails this process keeps on disk.",
+               lambda: thumbnails.disk_bytes)
+metrics.report('thumbnail_disk_evictions_total', 'counter', "Thumbnail files deleted to stay under the disk limit.",
+               lambda: thumbnails.evicted)
+metrics.report('answer_log_queued', 'gauge', "Answer events waiting to be written.",
+               answer_log.queued)
+metrics.report('answer_log_dropped_total', 'counter', "Answer events dropped because the queue was full.",
+               lambda: answer_log.dropped)
+metrics.report('validation_sessions', 'gauge', "Open incremental validation sessions.",
+               lambda: len(validation_sessions))
+
+@app.route('/metrics', methods=['GET'])
+def metrics_page():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+# For load balancers and serve.py: answers as soon as the app is loaded
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok', 'pid': os.getpid(), 'uptime': round(time.time() - started, 1)})
 
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
\ No newline at end of file
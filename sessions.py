@@ -0,0 +1,187 @@
+# Incremental validation sessions.
+#
+# A session holds the layout of one room on the server. Clients send small
+# add/move/remove deltas instead of the whole layout, and only the rules a
+# change can affect are checked again: those about the changed item's
+# type, line-of-sight rules whose items' sightlines its old or new cells
+# fall on, and the overlap rule, which any change can affect (see
+# RuleEngine.affected). The session's line-of-sight index is kept and
+# updated cell by cell. Responses carry just the feedback that changed.
+# Idle sessions are dropped from a bounded LRU.
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from visibility import Sightlines
+
+# How many sessions are kept, and how long an idle one lives (seconds)
+MAX_SESSIONS = 10000
+SESSION_TTL = 30 * 60
+
+
+class ValidationSession:
+    def __init__(self, engine, room, items):
+        self.engine = engine
+        self.room = room
+        self.items = {}
+        self.by_type = {}
+        self.lock = threading.Lock()
+        self.touched = time.monotonic()
+
+        self.sight = Sightlines(room, self.by_type)
+
+        for item_id, item in items.items():
+            self._place(item_id, item)
+
+        self.missing = engine.missing(self.by_type)
+        self.failed = engine.failed(room, self.by_type, self.sight)
+        self.feedback = engine.feedback(self.missing, self.failed)
+
+    def _place(self, item_id, item):
+        self.items[item_id] = item
+        self.by_type.setdefault(item.type, []).append(item)
+        self.sight.add(item)
+
+    def _take(self, item_id):
+        item = self.items.pop(item_id)
+        same = self.by_type[item.type]
+        same.remove(item)
+        if not same:
+            del self.by_type[item.type]
+        self.sight.remove(item)
+        return item
+
+    def apply(self, delta):
+        # Apply one delta; returns the item type it touched and the item's
+        # old and new placements
+        if not isinstance(delta, dict):
+            raise ValueError("A delta must be an object.")
+        op, item_id = delta.get('op'), delta.get('id')
+        if not isinstance(item_id, (str, int)):
+            raise ValueError("A delta needs an item id.")
+
+        if op == 'add':
+            if item_id in self.items:
+                raise ValueError(f"Item {item_id} is already placed.")
+            kind = delta.get('type')
+            if not isinstance(kind, str) or kind == 'room':
+                raise ValueError("Added items need a type.")
+            item = self.engine.item(self.room, kind, delta)
+            self._place(item_id, item)
+            return kind, (item,)
+
+        if item_id not in self.items:
+            raise ValueError(f"Item {item_id} is not placed.")
+        if op == 'move':
+            old = self.items[item_id]
+            spec = {'row': old.row, 'col': old.col, 'height': old.height, 'width': old.width}
+            spec.update((k, delta[k]) for k in spec if k in delta)
+            item = self.engine.item(self.room, old.type, spec)
+            self._take(item_id)
+            self._place(item_id, item)
+            return old.type, (old, item)
+        if op == 'remove':
+            item = self._take(item_id)
+            return item.type, (item,)
+        raise ValueError("A delta's op must be add, move or remove.")
+
+    def update(self, deltas):
+        # Apply deltas in order and re-check only the rules they can affect.
+        # Returns the messages that appeared and the ones that went away.
+        # {item type: old and new placements of its items}
+        touched = {}
+        before = self.feedback['feedback']
+        try:
+            for delta in deltas:
+                kind, changed = self.apply(delta)
+                touched.setdefault(kind, []).extend(changed)
+        finally:
+            # Keep the verdict in step with the deltas that did apply
+            self._recheck(touched)
+        after = self.feedback['feedback']
+
+        return {
+            'valid': self.feedback['valid'],
+            'added': [msg for msg in after if msg not in before],
+            'resolved': [msg for msg in before if msg not in after],
+        }
+
+    def _recheck(self, touched):
+        engine = self.engine
+        room, by_type = self.room, self.by_type
+        failed = self.failed
+        rules = set()
+        for kind, changed in touched.items():
+            rules.update(engine.affected(kind, changed, room, by_type))
+        for i in sorted(rules):
+            if engine.rule_broken(i, room, by_type, self.sight):
+                failed |= 1 << i
+            else:
+                failed &= ~(1 << i)
+        missing = engine.missing(self.by_type)
+
+        if (missing, failed) != (self.missing, self.failed):
+            self.missing, self.failed = missing, failed
+            self.feedback = engine.feedback(missing, failed)
+
+
+class SessionStore:
+    def __init__(self, engine, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL):
+        self.engine = engine
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, spec):
+        # spec is {"room": optional room override, "items": [{id, type, row, col, ...}]}
+        engine = self.engine
+        if not isinstance(spec, dict) or not isinstance(spec.get('items', []), list):
+            raise ValueError("A session needs a list of items.")
+        room = engine.room_for(spec['room']) if 'room' in spec else engine.room
+
+        items = {}
+        for item in spec.get('items', []):
+            if not isinstance(item, dict) or not isinstance(item.get('type'), str) or item['type'] == 'room':
+                raise ValueError("Each item needs an id and a type.")
+            item_id = item.get('id')
+            if not isinstance(item_id, (str, int)) or item_id in items:
+                raise ValueError("Each item needs a unique id.")
+            items[item_id] = engine.item(room, item['type'], item)
+
+        session = ValidationSession(engine, room, items)
+        session_id = secrets.token_urlsafe(16)
+        with self._lock:
+            self._expire()
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session_id, session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.touched = time.monotonic()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def _expire(self):
+        # Sessions are kept in least-recently-used order, so idle ones are
+        # always at the front
+        cutoff = time.monotonic() - self.ttl
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.touched >= cutoff:
+                break
+            del self._sessions[session_id]
+
+    def __len__(self):
+        return len(self._sessions)
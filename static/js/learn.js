@@ -10,6 +10,16 @@ function updateNavButtons() {
     }
 }
 
+function pictureHtml(data) {
+    // srcset variants come from the asset manifest when it has been built
+    const sizes = '(min-width: 768px) 65vw, 100vw';
+    const webp = data.image_webp_srcset
+        ? `<source type="image/webp" srcset="${data.image_webp_srcset}" sizes="${sizes}">` : '';
+    const srcset = data.image_srcset ? ` srcset="${data.image_srcset}" sizes="${sizes}"` : '';
+    return `<picture>${webp}<img src="${data.image}"${srcset} alt="${data.alt}" 
+        class="view-img img-fluid"></picture>`;
+}
+
 function showSection(sectionNum) {
     // loads data onto page from json
     let sectionData = learn_sections[sectionNum - 1];
@@ -17,8 +27,7 @@ function showSection(sectionNum) {
 
     $(".section-header").html(`${sectionData.title}`);
     $(".learn-text").html(sectionData.summary);
-    $(".learn-img").html(`<img src="${sectionData.image}" alt="${sectionData.alt}" 
-        class="view-img img-fluid">`);
+    $(".learn-img").html(pictureHtml(sectionData));
     $(".learn-text-sm").html(`<p>${sectionData.secondary}</p>`);
 
     updateNavButtons();
@@ -36,8 +45,7 @@ function showLesson(){
     });
     attrList += "</ul>";
     $(".attributes").append(attrList);
-    $(".learn-img").html(`<img src="${lessonData.image}" alt="${lessonData.alt}" 
-        class="view-img img-fluid">`);
+    $(".learn-img").html(pictureHtml(lessonData));
     $(".learn-text-sm").html(`<p>${lessonData.secondary}</p>`);
 
     updateNavButtons();
@@ -1,10 +1,11 @@
 // Wrap in an IIFE so code runs immediately
 (function() {
-    // Fixed grid size - 8x8
+    // Grid size and walls come from the server's room rules (data/room_rules.json)
     const GRID_SIZE = {
-        rows: 8,
-        cols: 8
+        rows: ROOM_RULES.grid.rows,
+        cols: ROOM_RULES.grid.cols
     };
+    const WALLS = ROOM_RULES.walls || [];
     
     // Current grid settings
     let currentGrid = {
@@ -15,9 +16,22 @@
     // Currently selected furniture
     let selectedFurniture = null;
     
+    // Incremental validation session on the server. Every change to the
+    // grid is sent as a small delta; once the user has validated, feedback
+    // is kept up to date as they move furniture around.
+    let sessionId = null;
+    let sessionQueue = Promise.resolve();
+    let liveFeedback = [];
+    let liveValidation = false;
+    
+    // Placed items get ids from a counter, so several placed at once differ
+    let nextItemId = 0;
+    
     // Initialize the simulator
     initializeGrid();
     initializeListeners();
+    startSession();
+    loadSharedLayout();
     
     function initializeListeners() {
         const gridContainer = document.getElementById('grid-container');
@@ -81,6 +95,11 @@
         if (validateBtn) {
             validateBtn.addEventListener('click', validatePlacement);
         }
+        
+        const saveBtn = document.getElementById('save-btn');
+        if (saveBtn) {
+            saveBtn.addEventListener('click', saveLayout);
+        }
     }
     
     function initializeGrid() {
@@ -105,6 +124,9 @@
                 cell.classList.add('grid-cell');
                 cell.setAttribute('data-row', row);
                 cell.setAttribute('data-col', col);
+                if (isWall(row, col)) {
+                    cell.classList.add('wall');
+                }
                 gridContainer.appendChild(cell);
             }
         }
@@ -143,9 +165,12 @@
             return false;
         }
         
-        // Check for overlap with existing furniture
+        // Check for overlap with walls and existing furniture
         for (let r = row; r < row + height; r++) {
             for (let c = col; c < col + width; c++) {
+                if (isWall(r, c)) {
+                    return false;
+                }
                 for (const id in currentGrid.furniture) {
                     const furniture = currentGrid.furniture[id];
                     if (isCellOccupied(r, c, furniture)) {
@@ -158,6 +183,10 @@
         return true;
     }
     
+    function isWall(row, col) {
+        return WALLS.some(wall => isCellOccupied(row, col, wall));
+    }
+    
     function isCellOccupied(row, col, furniture) {
         return row >= furniture.row && 
                row < furniture.row + furniture.height &&
@@ -193,7 +222,7 @@
         gridWrapper.appendChild(furnitureElement);
         
         // Store furniture in grid data
-        const id = Date.now().toString();
+        const id = `${Date.now()}-${nextItemId++}`;
         currentGrid.furniture[id] = {
             id,
             type: furniture.type,
@@ -203,6 +232,7 @@
             height: furniture.height,
             element: furnitureElement
         };
+        sendDelta(itemDelta('add', currentGrid.furniture[id]));
         
         // Make placed furniture draggable so it can be picked up
         furnitureElement.setAttribute('draggable', 'true');
@@ -217,6 +247,7 @@
             }));
             // Remove from grid data and DOM
             delete currentGrid.furniture[id];
+            sendDelta({ op: 'remove', id });
             setTimeout(() => furnitureElement.remove(), 0);
         });
         
@@ -228,6 +259,7 @@
             const w = item.width, h = item.height;
             item.width = h;
             item.height = w;
+            sendDelta(itemDelta('move', item));
             // update styles
             const newW = h * currentGrid.cellSize;
             const newH = w * currentGrid.cellSize;
@@ -239,25 +271,99 @@
         furnitureElement.addEventListener('contextmenu', function(e) {
             e.preventDefault();
             delete currentGrid.furniture[id];
+            sendDelta({ op: 'remove', id });
             furnitureElement.remove();
         });
     }
     
-    function validatePlacement() {
-        // Create a simplified data structure for the server
+    function itemDelta(op, item) {
+        return {
+            op,
+            id: item.id,
+            type: item.type,
+            row: item.row,
+            col: item.col,
+            width: item.width,
+            height: item.height
+        };
+    }
+    
+    function postJSON(url, body) {
+        return fetch(url, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify(body)
+        });
+    }
+    
+    // (Re)creates the session from the whole grid
+    function startSession() {
+        const items = Object.values(currentGrid.furniture).map(item => itemDelta('add', item));
+        sessionQueue = sessionQueue
+            .then(() => postJSON('/validation_sessions', { items }))
+            .then(response => response.json())
+            .then(data => {
+                sessionId = data.session;
+                liveFeedback = data.feedback;
+                if (liveValidation) {
+                    showFeedback(liveFeedback, data.valid);
+                }
+            })
+            .catch(error => console.error('Error starting validation session:', error));
+    }
+    
+    // Deltas are sent one at a time, in order
+    function sendDelta(delta) {
+        sessionQueue = sessionQueue
+            .then(() => postJSON(`/validation_sessions/${sessionId}/deltas`, delta))
+            .then(response => {
+                if (!response.ok) {
+                    // Expired session or out of sync: start over from the grid
+                    startSession();
+                    return;
+                }
+                return response.json().then(data => {
+                    liveFeedback = liveFeedback
+                        .filter(message => !data.resolved.includes(message))
+                        .concat(data.added);
+                    if (liveValidation) {
+                        showFeedback(liveFeedback, data.valid);
+                    }
+                });
+            })
+            .catch(error => console.error('Error updating validation session:', error));
+    }
+    
+    // The grid as the server reads it: {type: item}, or a list of items
+    function getPlacementData() {
         const placementData = {};
         
         for (const id in currentGrid.furniture) {
             const item = currentGrid.furniture[id];
-            // If there are multiple of one type, the last one will be used
-            placementData[item.type] = {
+            const data = {
                 row: item.row,
                 col: item.col,
                 width: item.width,
                 height: item.height,
                 type: item.type
             };
+            // Several items of one type are sent as a list
+            if (!(item.type in placementData)) {
+                placementData[item.type] = data;
+            } else if (Array.isArray(placementData[item.type])) {
+                placementData[item.type].push(data);
+            } else {
+                placementData[item.type] = [placementData[item.type], data];
+            }
         }
+        return placementData;
+    }
+    
+    function validatePlacement() {
+        // Create a simplified data structure for the server
+        const placementData = getPlacementData();
         
         // Check if we have enough items to validate
         if (Object.keys(placementData).length < 2) {
@@ -276,6 +382,7 @@
         .then(response => response.json())
         .then(data => {
             showFeedback(data.feedback, data.valid);
+            liveValidation = true;
         })
         .catch(error => {
             console.error('Error validating placement:', error);
@@ -283,6 +390,47 @@
         });
     }
     
+    // Saves the grid to the gallery and shows a link that opens it again
+    function saveLayout() {
+        const shareLink = document.getElementById('share-link');
+        postJSON('/gallery', getPlacementData())
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    shareLink.textContent = data.error;
+                    return;
+                }
+                const url = `${window.location.origin}${window.location.pathname}?layout=${data.id}`;
+                shareLink.innerHTML = '';
+                const link = document.createElement('a');
+                link.href = url;
+                link.textContent = url;
+                shareLink.append(data.created ? 'Saved! Share it: ' : 'Already saved. Share it: ', link);
+            })
+            .catch(error => {
+                console.error('Error saving layout:', error);
+                shareLink.textContent = 'Error saving layout. Please try again.';
+            });
+    }
+    
+    // Places the items of a shared layout (?layout=<id>) on the grid
+    function loadSharedLayout() {
+        const layoutId = new URLSearchParams(window.location.search).get('layout');
+        if (!layoutId) return;
+        
+        fetch(`/gallery/${encodeURIComponent(layoutId)}`)
+            .then(response => response.json())
+            .then(data => {
+                // Layouts in other rooms can't be drawn on this grid
+                if (data.error || data.placement.room) return;
+                for (const type in data.placement) {
+                    const items = [].concat(data.placement[type]);
+                    items.forEach(item => placeFurniture(item.row, item.col, item));
+                }
+            })
+            .catch(error => console.error('Error loading shared layout:', error));
+    }
+    
     function showFeedback(messages, isValid) {
         const feedbackContainer = document.getElementById('feedback-container');
         if (!feedbackContainer) return;
@@ -0,0 +1,244 @@
+# PNG thumbnails of room layouts, for the gallery, challenge lists and
+# share links.
+#
+# A layout is drawn into a NumPy array of palette indexes, a few cells'
+# worth of pixels per grid cell, with the simulator's colors: grid lines,
+# walls, and every item's footprint with its border. With the overlay on,
+# items named by a broken rule get a red border and the picture a green or
+# red frame. The array goes straight into a 4-bit palette PNG with zlib, no
+# imaging library needed.
+#
+# Thumbnails are keyed by canonical layout digest and transform (see
+# canonical.py) plus the drawing options, and the ETag is derived from that
+# key, so a matching If-None-Match is answered before anything is drawn.
+# Rendered PNGs are kept in an LRU bounded by bytes, and optionally on disk
+# under the same key, where the least recently used files are deleted once
+# they pass DISK_BYTES. What's on disk is found when the process starts;
+# behind serve.py each worker then bounds the files it knows of, so several
+# workers can together keep a few times DISK_BYTES.
+
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from canonical import canonical
+
+# Pixels per grid cell, by default and at most, and the longest side drawn
+CELL_SIZE = 12
+MAX_CELL_SIZE = 32
+MAX_SIDE = 1024
+
+# Bytes of PNGs kept in memory, and on disk
+CACHE_BYTES = 16 * 1024 * 1024
+DISK_BYTES = 256 * 1024 * 1024
+
+# Bump whenever the drawing changes, so old ETags and files aren't reused
+RENDER_VERSION = '1'
+
+# Palette, from the simulator page's colors
+BACKGROUND, GRID, WALL, RED, GREEN = range(5)
+PALETTE = [
+    (0xf8, 0xf9, 0xfa),
+    (0xdd, 0xdd, 0xdd),
+    (0x88, 0x88, 0x88),
+    (0xdc, 0x35, 0x45),
+    (0x28, 0xa7, 0x45),
+]
+
+# (fill, border) per item type; other types are drawn like chairs
+ITEM_COLORS = {
+    'door': ((0x73, 0x55, 0x57), (0x43, 0x43, 0x43)),
+    'chair': ((0xd2, 0x9f, 0x7f), (0x73, 0x55, 0x57)),
+    'desk': ((0xd2, 0x9f, 0x7f), (0x73, 0x55, 0x57)),
+    'bed': ((0xea, 0xd1, 0xdb), (0xea, 0xb9, 0xc1)),
+    'mirror': ((0xcc, 0xcc, 0xcc), (0x88, 0x88, 0x88)),
+}
+
+def _index(color):
+    if color not in PALETTE:
+        PALETTE.append(color)
+    return PALETTE.index(color)
+
+_ITEM_INDEX = {kind: (_index(fill), _index(border)) for kind, (fill, border) in ITEM_COLORS.items()}
+_OTHER = _ITEM_INDEX['chair']
+
+
+def cell_size(room, requested=CELL_SIZE):
+    # Pixels per cell: as requested, but no side longer than MAX_SIDE
+    return max(1, min(requested, MAX_CELL_SIZE, (MAX_SIDE - 1) // max(room.rows, room.cols)))
+
+
+def draw(engine, room, by_type, cell, overlay=False):
+    # Palette indexes of the thumbnail, shape (rows*cell + 1, cols*cell + 1)
+    image = np.full((room.rows * cell + 1, room.cols * cell + 1), BACKGROUND, dtype=np.uint8)
+    if cell >= 4:
+        image[::cell, :] = GRID
+        image[:, ::cell] = GRID
+    for row, col, height, width in room.walls:
+        image[row*cell:(row+height)*cell + 1, col*cell:(col+width)*cell + 1] = WALL
+
+    flagged = set()
+    if overlay:
+        missing = engine.missing(by_type)
+        failed = 0 if missing else engine.failed(room, by_type)
+        for i, rule in enumerate(engine.rules):
+            if failed & (1 << i):
+                flagged |= rule.types
+
+    line = max(1, cell // 6)
+    for kind, items in by_type.items():
+        fill, border = _ITEM_INDEX.get(kind, _OTHER)
+        if kind in flagged:
+            border = RED
+        for item in items:
+            y0, x0 = item.row * cell, item.col * cell
+            y1, x1 = y0 + item.height * cell + 1, x0 + item.width * cell + 1
+            image[y0:y1, x0:x1] = border
+            image[y0+line:y1-line, x0+line:x1-line] = fill
+
+    if overlay:
+        status = GREEN if not (missing or failed) else RED
+        frame = max(2, cell // 4)
+        image[:frame, :] = image[-frame:, :] = status
+        image[:, :frame] = image[:, -frame:] = status
+    return image
+
+
+def _chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+
+def encode_png(image, palette=PALETTE):
+    # A 4-bit palette PNG of an array of palette indexes
+    height, width = image.shape
+    if width % 2:
+        image = np.pad(image, ((0, 0), (0, 1)))
+    packed = (image[:, 0::2] << 4) | image[:, 1::2]
+    # Every scanline starts with filter type 0
+    raw = np.zeros((height, packed.shape[1] + 1), dtype=np.uint8)
+    raw[:, 1:] = packed
+    return (b'\x89PNG\r\n\x1a\n' +
+            _chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 4, 3, 0, 0, 0)) +
+            _chunk(b'PLTE', bytes(c for color in palette for c in color)) +
+            _chunk(b'IDAT', zlib.compress(raw.tobytes(), 9)) +
+            _chunk(b'IEND', b''))
+
+
+class Thumbnails:
+    def __init__(self, engine, max_bytes=CACHE_BYTES, disk_dir=None, max_disk_bytes=DISK_BYTES):
+        self.engine = engine
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        self._pngs = OrderedDict()
+        self._bytes = 0
+        # {etag: size} of the files on disk, least recently used first
+        self._files = OrderedDict()
+        self.disk_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = self.evicted = 0
+        if disk_dir is not None:
+            self._scan()
+
+    def _scan(self):
+        # The files already on disk, oldest first
+        found = []
+        try:
+            folders = [entry.path for entry in os.scandir(self.disk_dir) if entry.is_dir()]
+        except OSError:
+            return
+        for folder in folders:
+            try:
+                for entry in os.scandir(folder):
+                    if entry.name.endswith('.png'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.name[:-4], stat.st_size))
+            except OSError:
+                continue
+        for _, etag, size in sorted(found):
+            self._files[etag] = size
+            self.disk_bytes += size
+        self._evict()
+
+    def _evict(self):
+        # Delete least recently used files until the rest fit; called with
+        # the lock held, or before the object is shared
+        while self.disk_bytes > self.max_disk_bytes and self._files:
+            etag, size = self._files.popitem(last=False)
+            self.disk_bytes -= size
+            self.evicted += 1
+            try:
+                os.remove(self._path(etag))
+            except OSError:
+                # Already gone, deleted by another worker
+                pass
+
+    def etag(self, room, by_type, cell, overlay=False):
+        # Strong ETag of the thumbnail, without drawing it. Overlays depend
+        # on the rules too.
+        form = canonical(room, by_type)
+        key = f"{RENDER_VERSION}:{form.digest}:{form.transform}:{cell}"
+        if overlay:
+            key += ':' + self.engine.version.hex()
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def _path(self, etag):
+        return os.path.join(self.disk_dir, etag[:2], etag + '.png')
+
+    def png(self, etag, room, by_type, cell, overlay=False):
+        # The thumbnail under `etag` (from etag() with the same arguments):
+        # from memory, from disk, or drawn
+        with self._lock:
+            data = self._pngs.get(etag)
+            if data is not None:
+                self._pngs.move_to_end(etag)
+                self.hits += 1
+                return data
+
+        data = None
+        if self.disk_dir is not None:
+            try:
+                with open(self._path(etag), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                pass
+        if data is not None:
+            with self._lock:
+                self.disk_hits += 1
+                if etag in self._files:
+                    self._files.move_to_end(etag)
+                else:
+                    # Written by another worker
+                    self._files[etag] = len(data)
+                    self.disk_bytes += len(data)
+                    self._evict()
+        else:
+            data = encode_png(draw(self.engine, room, by_type, cell, overlay))
+            with self._lock:
+                self.misses += 1
+            if self.disk_dir is not None:
+                path = self._path(etag)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Unique to this process and thread: workers write the same
+                # thumbnail at once
+                tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+                with self._lock:
+                    self.disk_bytes += len(data) - self._files.pop(etag, 0)
+                    self._files[etag] = len(data)
+                    self._evict()
+
+        with self._lock:
+            if etag not in self._pngs:
+                self._pngs[etag] = data
+                self._bytes += len(data)
+                while self._bytes > self.max_bytes:
+                    self._bytes -= len(self._pngs.popitem(last=False)[1])
+        return data
@@ -0,0 +1,113 @@
+# Precomputed verdicts for every layout of the placement grid.
+#
+# With four required items at their default footprints on an 8x8 grid
+# there are only 64^4 layouts, so the failed-rule mask of each one fits in
+# a 16 MB table: one byte per layout, indexed by the top-left cells of
+# door, bed, desk and mirror. The server maps the file at startup and
+# answers validations with a single lookup.
+#
+# Build it offline with:  python verdict_table.py [path]
+
+import logging
+import mmap
+import os
+import sys
+
+import numpy as np
+
+from placement import GRID_ROWS, GRID_COLS, REQUIRED, RULE_MESSAGES, RULE_VERSION, engine
+from placement_batch import Rects, failure_masks, vectorizable
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'verdicts.bin')
+
+MAGIC = b'FSVT\x01'
+HEADER_SIZE = len(MAGIC) + len(RULE_VERSION)
+
+CELLS = GRID_ROWS * GRID_COLS
+TABLE_SIZE = CELLS ** len(REQUIRED)
+
+# Stored for layouts left to the live rules: items off the grid, which they
+# reject outright
+NOT_COVERED = 0xff
+
+log = logging.getLogger(__name__)
+
+
+class VerdictTable:
+    def __init__(self, buf):
+        self._buf = buf
+
+    def lookup(self, placement):
+        # Failed-rule mask for the layout, or None if it isn't in the table
+        # (missing or extra items, rotated footprints, off-grid cells, ...)
+        if not isinstance(placement, dict) or len(placement) != len(REQUIRED):
+            return None
+        index = 0
+        try:
+            for req in REQUIRED:
+                item = placement[req]
+                r, c = item['row'], item['col']
+                if type(r) is not int or type(c) is not int:
+                    return None
+                if not (0 <= r < GRID_ROWS and 0 <= c < GRID_COLS):
+                    return None
+                height, width = engine.footprint(req)
+                if item.get('height', height) != height or item.get('width', width) != width:
+                    return None
+                index = index * CELLS + r * GRID_COLS + c
+        except (TypeError, KeyError, AttributeError):
+            return None
+        failed = self._buf[HEADER_SIZE + index]
+        return None if failed == NOT_COVERED else failed
+
+    def close(self):
+        self._buf.close()
+
+
+def load(path=DEFAULT_PATH):
+    # Map a verdict table, or return None so callers use the live rules
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return None
+
+    with f:
+        if os.fstat(f.fileno()).st_size != HEADER_SIZE + TABLE_SIZE:
+            log.warning("Ignoring verdict table %s: unexpected size", path)
+            return None
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buf[:HEADER_SIZE] != MAGIC + RULE_VERSION:
+        log.warning("Ignoring verdict table %s: built for different rules", path)
+        buf.close()
+        return None
+    return VerdictTable(buf)
+
+
+def build(path=DEFAULT_PATH):
+    if len(RULE_MESSAGES) >= 8:
+        raise ValueError("Verdict tables hold at most 7 rules")
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # Every cell combination of the other items for one cell of the first
+    rest = np.indices((CELLS,) * (len(REQUIRED) - 1)).reshape(len(REQUIRED) - 1, -1).T
+    cells = np.empty((len(rest), len(REQUIRED)), dtype=np.int64)
+    cells[:, 1:] = rest
+    footprints = np.array([engine.footprint(req) for req in REQUIRED])
+    heights = np.broadcast_to(footprints[:, 0], cells.shape)
+    widths = np.broadcast_to(footprints[:, 1], cells.shape)
+
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC + RULE_VERSION)
+        for first in range(CELLS):
+            cells[:, 0] = first
+            rects = Rects(cells // GRID_COLS, cells % GRID_COLS, heights, widths)
+            masks = failure_masks(rects)
+            masks[~vectorizable(rects)] = NOT_COVERED
+            f.write(masks.astype(np.uint8).tobytes())
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    build(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH)
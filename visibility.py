@@ -0,0 +1,139 @@
+# Line of sight between items on a room grid.
+#
+# Sightlines run from the centre of one item's footprint to the centre of
+# the other's. A sightline is blocked when it passes through the inside of
+# any cell covered by a wall or by a third item; grazing a cell's corner or
+# running along a grid line doesn't count.
+#
+# The spatial index is one occupancy bitset per row and per column, built
+# once per layout and updated in place as items are added or removed. A
+# ray is checked one row (or column, whichever axis it crosses fewer of) at
+# a time: the cells it crosses in a row form a single run, so each step is
+# one AND against that row's bitset. All arithmetic is done on integers in
+# half-cell units, so results are exact.
+
+
+def _run(length, start):
+    return ((1 << length) - 1) << start
+
+
+def _blocked(lines, a, b):
+    # a and b are (start, length, cross_start, cross_length) rectangles in the
+    # orientation of `lines`: lines[i] is the bitset of line i, and bit j of
+    # it is the cell at cross position j
+    (ay, ah, ax, aw), (by, bh, bx, bw) = a, b
+    y0, x0, y1, x1 = 2*ay + ah, 2*ax + aw, 2*by + bh, 2*bx + bw
+    if y0 > y1:
+        y0, x0, y1, x1 = y1, x1, y0, x0
+    dy, dx = y1 - y0, x1 - x0
+
+    if dy == 0:
+        # The ray runs along one line, or along the grid line between two
+        if dx == 0 or y0 % 2 == 0:
+            return False
+        spans = [((y0 - 1) // 2, min(x0, x1) // 2, (max(x0, x1) - 1) // 2)]
+    else:
+        spans = []
+        for i in range(y0 // 2, (y1 - 1) // 2 + 1):
+            na = x0*dy + (max(y0, 2*i) - y0) * dx
+            nb = x0*dy + (min(y1, 2*i + 2) - y0) * dx
+            if na > nb:
+                na, nb = nb, na
+            spans.append((i, na // (2*dy), (nb - 1) // (2*dy)))
+
+    for i, lo, hi in spans:
+        if lo > hi:
+            continue
+        hit = lines[i] & _run(hi - lo + 1, lo)
+        if not hit:
+            continue
+        # The two items' own cells never block
+        if ay <= i < ay + ah:
+            hit &= ~_run(aw, ax)
+        if by <= i < by + bh:
+            hit &= ~_run(bw, bx)
+        if hit:
+            return True
+    return False
+
+
+class Sightlines:
+    # Line-of-sight queries for one layout. The occupancy index is built on
+    # the first query and answers are remembered per pair of items. When
+    # by_type changes, call add or remove for each item so the index (if
+    # it's been built) and the answers follow.
+
+    def __init__(self, room, by_type):
+        self.room = room
+        self.by_type = by_type
+        self._rows = None
+        self._cols = None
+        self._clear = {}
+
+    def _index(self):
+        self._rows = list(self.room.wall_rows)
+        self._cols = list(self.room.wall_cols)
+        for items in self.by_type.values():
+            for item in items:
+                self._mark(item)
+
+    def _mark(self, item):
+        rows, cols = self._rows, self._cols
+        line = _run(item.width, item.col)
+        for r in range(item.row, item.row + item.height):
+            rows[r] |= line
+        line = _run(item.height, item.row)
+        for c in range(item.col, item.col + item.width):
+            cols[c] |= line
+
+    def _forget(self, item):
+        # Drop the answers a change over item's cells may have changed: the
+        # pairs whose sightline (inside the rectangle spanning them) it lies
+        # on
+        row0, row1 = item.row, item.row + item.height
+        col0, col1 = item.col, item.col + item.width
+        self._clear = {
+            (a, b): clear for (a, b), clear in self._clear.items()
+            if not (min(a.row, b.row) < row1 and row0 < max(a.row + a.height, b.row + b.height) and
+                    min(a.col, b.col) < col1 and col0 < max(a.col + a.width, b.col + b.width))}
+
+    def add(self, item):
+        # An item just put in by_type
+        self._forget(item)
+        if self._rows is not None:
+            self._mark(item)
+
+    def remove(self, item):
+        # An item just taken out of by_type. Its cells are cleared, then
+        # those a wall or another item also covers are marked again.
+        self._forget(item)
+        if self._rows is None:
+            return
+        rows, cols = self._rows, self._cols
+        line = _run(item.width, item.col)
+        for r in range(item.row, item.row + item.height):
+            rows[r] = (rows[r] & ~line) | (self.room.wall_rows[r] & line)
+        line = _run(item.height, item.row)
+        for c in range(item.col, item.col + item.width):
+            cols[c] = (cols[c] & ~line) | (self.room.wall_cols[c] & line)
+        for items in self.by_type.values():
+            for other in items:
+                if other.mask & item.mask:
+                    self._mark(other)
+
+    def clear(self, a, b):
+        # Can a and b see each other?
+        key = (a, b) if a <= b else (b, a)
+        clear = self._clear.get(key)
+        if clear is None:
+            if self._rows is None:
+                self._index()
+            ra = (a.row, a.height, a.col, a.width)
+            rb = (b.row, b.height, b.col, b.width)
+            # Step across whichever axis the ray crosses fewer lines of
+            if abs(2*(b.row - a.row) + b.height - a.height) <= abs(2*(b.col - a.col) + b.width - a.width):
+                clear = not _blocked(self._rows, ra, rb)
+            else:
+                clear = not _blocked(self._cols, ra[2:] + ra[:2], rb[2:] + rb[:2])
+            self._clear[key] = clear
+        return clear